@@ -16,7 +16,13 @@ from aarddict import dictionary
 
 
 import collections
-from aardtools.compiler import ArticleSource, Article
+from icu import ICU_VERSION
+from aardtools.compiler import ArticleSource, Article, VolumeReader
+
+#metadata describing layout of input volumes rather than dictionary
+FORMAT_METADATA_KEYS = ('sections', 'front_coding_block',
+                        'preset_dictionary', 'first_title', 'last_title',
+                        'icu_version')
 
 
 class AardArticleSource(ArticleSource, collections.Sized):
@@ -27,30 +33,67 @@ class AardArticleSource(ArticleSource, collections.Sized):
 
     @classmethod
     def register_args(cls, parser):
-        pass
+        parser.add_argument(
+            '--passthrough',
+            action='store_true',
+            help=('Copy compressed articles from input volumes as is '
+                  'instead of decompressing and compressing them again. '
+                  'Articles stored in blocks or compressed with preset '
+                  'dictionary are still recompressed. Index order of '
+                  'single input volume is kept'))
 
     def __init__(self, args):
         super(AardArticleSource, self).__init__(self)
         self.input_files = args.input_files
+        self.passthrough = args.passthrough
+        #index of each input volume is sorted,
+        #but volumes together are not
+        self.presorted = self.passthrough and len(self.input_files) == 1
+        if self.presorted:
+            #keys of other ICU version may collate differently
+            volume = VolumeReader(self.input_files[0])
+            icu_version = volume.metadata.get('icu_version')
+            volume.close()
+            self.same_collation = icu_version == ICU_VERSION
         self._metadata = {}
 
     @property
     def metadata(self):
         return self._metadata
 
+    def update_metadata(self, metadata):
+        for key, value in metadata.iteritems():
+            if key not in FORMAT_METADATA_KEYS:
+                self._metadata[key] = value
+
     def __len__(self):
         count = 0
         for name in self.input_files:
-            d = dictionary.Volume(name)
+            if self.passthrough:
+                d = VolumeReader(name)
+            else:
+                d = dictionary.Volume(name)
             count += len(d)
             d.close()
         return count
 
     def __iter__(self):
+        if self.passthrough:
+            for article in self.stored_articles():
+                yield article
+            return
         for name in self.input_files:
             d = dictionary.Volume(name)
-            self._metadata.update(d.metadata)
+            self.update_metadata(d.metadata)
             for i, article in enumerate(d.articles):
                 title= d.words[i]
                 yield Article(title, article)
             d.close()
+
+    def stored_articles(self):
+        for name in self.input_files:
+            volume = VolumeReader(name)
+            self.update_metadata(volume.metadata)
+            for i, title in enumerate(volume.titles()):
+                yield volume.stored_article(i, title)
+            volume.close()
@@ -17,21 +17,31 @@
 
 
 import argparse
+import base64
+import bisect
 import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import math
+import Queue
 import mmap
+import multiprocessing
 import os
+import re
 import shutil
 import struct
 import sys
 import tempfile
 import time
+import unicodedata
 import uuid
 
 from datetime import timedelta
 
-from icu import Locale, Collator
+from icu import Locale, Collator, ICU_VERSION
 
 
 from aarddict.dictionary import HEADER_SPEC, spec_len, calcsha1, collation_key
@@ -47,6 +57,17 @@ MAX_FAT32_FILE_SIZE = 2**32-1
 KEY_LENGTH_FORMAT = '>H'
 ARTICLE_LENGTH_FORMAT = '>L'
 INDEX1_ITEM_FORMAT = '>LL'
+#in-block offset of index 1 items pointing to articles not in a block
+NO_BLOCK = 0xFFFFFFFF
+#format versions that introduced optional features, volume has the
+#highest version of features it uses, so version tells which
+#features reader must support and features that are actually used
+#are told by index 1 item format and metadata
+ARTICLE_BLOCKS_VERSION = 2
+FRONT_CODED_INDEX_VERSION = 3
+#older readers would show articles compressed against
+#preset dictionary as garbage
+PRESET_DICTIONARY_VERSION = 4
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 import collections
@@ -56,7 +77,7 @@ class Article(object):
 
     def __init__(self, title, text,
                  isredirect=False, counted=True,
-                 failed=False, skipped=False):
+                 failed=False, skipped=False, source_digest=None):
         """
         Parameters:
 
@@ -85,6 +106,12 @@ class Article(object):
         skipped
           True if article source skipped the article
 
+        source_digest
+          Digest of input article was converted from (see
+          :func:`source_digest`), recorded in build manifest so that
+          next build can reuse article if input didn't change. Entries
+          generated from the same input share its digest.
+
         """
         self.title = title
         self.text = text
@@ -92,12 +119,65 @@ class Article(object):
         self.counted = counted
         self.failed = failed
         self.skipped = skipped
+        self.source_digest = source_digest
 
     @property
     def empty(self):
         return not self.text or not self.title
 
 
+class PreparedArticle(Article):
+
+    def __init__(self, title, compressed, sort_key=None,
+                 isredirect=False, counted=True, source_digest=None):
+        """
+        Article that article source already compressed and, optionally,
+        computed title collation key for, typically in its worker
+        processes (see :func:`prepare`). Compiler stores both as is.
+
+        compressed
+          Compressed article text
+
+        sort_key
+          Collation key of utf8-encoded title
+          (``collation_key(title).getByteArray()``) or None
+
+        """
+        Article.__init__(self, title, None,
+                         isredirect=isredirect, counted=counted,
+                         source_digest=source_digest)
+        self.compressed = compressed
+        self.sort_key = sort_key
+
+    @property
+    def empty(self):
+        return not self.compressed or not self.title
+
+
+def prepare(title, text):
+    """
+    Compress article text and compute title collation key.
+    Meant to be called by article sources in their worker processes,
+    result is used to create :class:`PreparedArticle`.
+
+    """
+    if isinstance(title, unicode):
+        title = title.encode('utf8')
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    #preset dictionary, if any, is trained after article
+    #source workers are started
+    _codec, compressed, _ = run_codecs(text, BASE_CODECS)
+    return compressed, collation_key(title).getByteArray()
+
+
+class ResumeError(Exception):
+    """
+    Raised by article source if compilation can't be
+    resumed from position recorded at checkpoint
+    """
+
+
 class ArticleSource(collections.Iterable):
 
     """
@@ -152,6 +232,59 @@ class ArticleSource(collections.Iterable):
         """
         return True
 
+    #article sources that yield articles in collation order of
+    #their titles set this so that volumes are only checked to be
+    #in order rather than sorted again
+    presorted = False
+
+    #presorted article sources whose order was produced with
+    #the same collation set this so that order is not checked either
+    same_collation = False
+
+    #article sources that can continue compilation from a checkpoint
+    #set this and keep `position` up to date
+    resumable = False
+
+    #JSON serializable position right after the last article
+    #yielded, None if compilation can't be resumed from there
+    position = None
+
+    def resume(self, position):
+        """
+        Make iteration start at `position` previously
+        obtained from this article source, raise ResumeError
+        if position can't be found in input
+
+        """
+        raise NotImplementedError('%s can\'t resume' % self.name())
+
+    #article sources that supply source digests and take
+    #unchanged articles from `previous` build set this
+    reuses_previous = False
+
+    #PreviousBuild, set by compiler before iteration
+    previous = None
+
+
+def positioned(source, articles, position):
+    """
+    Yield `articles` that come from the same unit of input, setting
+    `position` of article `source` to `position` when yielding
+    the last one so that the unit is never split by a checkpoint.
+
+    >>> class Source(object): pass
+    >>> source = Source()
+    >>> for a in positioned(source, 'ab', {'n': 1}):
+    ...     print a, source.position
+    a None
+    b {'n': 1}
+
+    """
+    articles = list(articles)
+    for i, article in enumerate(articles):
+        source.position = position if i == len(articles) - 1 else None
+        yield article
+
 
 class DummyArticleSource(ArticleSource, collections.Sized):
 
@@ -167,9 +300,12 @@ class DummyArticleSource(ArticleSource, collections.Sized):
             default=100,
             help= 'Number of "articles" in dummy source')
 
+    resumable = True
+
     def __init__(self, args):
         super(DummyArticleSource, self).__init__(self)
         self.len = args.len
+        self.start = 0
 
     def __len__(self):
         return self.len
@@ -179,7 +315,8 @@ class DummyArticleSource(ArticleSource, collections.Sized):
         return {}
 
     def __iter__(self):
-        for i in range(len(self)):
+        for i in range(self.start, len(self)):
+            self.position = {'items': i + 1}
             title = 'title %s' % i
             text = 'article %s' %i
             if i % 4 == 0:
@@ -191,6 +328,9 @@ class DummyArticleSource(ArticleSource, collections.Sized):
             else:
                 yield Article(title, json.dumps((text, [])))
 
+    def resume(self, position):
+        self.start = position['items']
+
 
 def utf8(func):
     def f(*args, **kwargs):
@@ -207,6 +347,539 @@ def utf8(func):
     return f
 
 
+def copy_file(file_name, output_file, buf_size, offset=0):
+    with open(file_name) as f:
+        f.seek(offset)
+        while True:
+            data = f.read(buf_size)
+            if len(data) == 0:
+                break
+            output_file.write(data)
+
+
+class ChecksumWriter(object):
+    """
+    File wrapper calculating sha1 sum of everything written
+    to it except for first `skip` bytes and, optionally,
+    extent checksums of everything except for first
+    `extents_skip` bytes
+    """
+
+    def __init__(self, f, skip, extents=None, extents_skip=0):
+        self.f = f
+        self.skip = skip
+        self.pos = 0
+        self.sha1 = hashlib.sha1()
+        self.extents = extents
+        self.extents_skip = extents_skip
+
+    def write(self, data):
+        self.f.write(data)
+        self.update(data)
+
+    def update(self, data):
+        """
+        Account for data that is already in the file
+        """
+        if self.pos + len(data) > self.skip:
+            self.sha1.update(data[max(self.skip - self.pos, 0):])
+        if self.extents and self.pos + len(data) > self.extents_skip:
+            self.extents.update(data[max(self.extents_skip - self.pos, 0):])
+        self.pos += len(data)
+
+
+EXTENT_CHECKSUMS = 'extent_checksums'
+EXTENT_CHECKSUMS_HEADER_FORMAT = '>LL'
+
+class ExtentChecksums(object):
+    """
+    CRC32 checksums of consecutive fixed size extents of data,
+    the last extent may be shorter
+
+    >>> c = ExtentChecksums(4)
+    >>> c.update('abcdef'); c.update('gh'); c.update('i')
+    >>> c.crcs() == [zlib.crc32(s) & 0xffffffff for s in ('abcd', 'efgh', 'i')]
+    True
+    >>> len(c.table()) == ExtentChecksums.table_len(4, 9)
+    True
+
+    """
+
+    def __init__(self, extent_size):
+        self.extent_size = extent_size
+        self.done = []
+        self.crc = 0
+        self.filled = 0
+
+    def update(self, data):
+        while data:
+            n = min(len(data), self.extent_size - self.filled)
+            self.crc = zlib.crc32(data[:n], self.crc)
+            self.filled += n
+            data = data[n:]
+            if self.filled == self.extent_size:
+                self.done.append(self.crc & 0xffffffff)
+                self.crc = 0
+                self.filled = 0
+
+    def crcs(self):
+        if self.filled:
+            return self.done + [self.crc & 0xffffffff]
+        return self.done
+
+    def table(self):
+        crcs = self.crcs()
+        return (struct.pack(EXTENT_CHECKSUMS_HEADER_FORMAT,
+                            self.extent_size, len(crcs)) +
+                struct.pack('>%dL' % len(crcs), *crcs))
+
+    @staticmethod
+    def table_len(extent_size, data_len):
+        extent_count = (data_len + extent_size - 1)/extent_size
+        return struct.calcsize(EXTENT_CHECKSUMS_HEADER_FORMAT) + 4*extent_count
+
+
+class Section(object):
+    """
+    Optional volume section written after articles. Section's
+    location is stored in volume metadata under its name.
+
+    """
+
+    __metaclass__ = ABCMeta
+
+    #bytes taken regardless of number of items,
+    #including section's entry in metadata
+    fixed_size = 64
+
+    #whether collation keys computed to sort the index
+    #should be kept for this section
+    uses_sort_keys = False
+
+    @abstractproperty
+    def name(self):
+        pass
+
+    @abstractmethod
+    def item_size(self, title):
+        """
+        Return number of bytes this section may grow by
+        when an item with given title is added
+        """
+
+    @abstractmethod
+    def build(self, volume, f):
+        """
+        Write section data to file `f`, volume's index is
+        already sorted
+        """
+
+
+#generous estimate of sort key bytes per byte of UTF-8 encoded
+#title at each strength, plus level separators and terminator
+COLLATION_KEY_BYTES_PER_TITLE_BYTE = {Collator.PRIMARY: 2,
+                                      Collator.SECONDARY: 3,
+                                      Collator.TERTIARY: 4,
+                                      Collator.QUATERNARY: 5}
+COLLATION_KEY_OVERHEAD = 5
+
+def estimated_key_len(text, strength):
+    """
+    Upper estimate of length of sort key of utf8-encoded `text`
+    """
+    return (COLLATION_KEY_OVERHEAD +
+            COLLATION_KEY_BYTES_PER_TITLE_BYTE[strength]*len(text))
+
+
+def title_prefixes(title, count):
+    """
+    Return prefixes of title of 1 to `count` characters, combining
+    marks belong to the character they follow.
+
+    >>> title_prefixes(u'abcd', 3)
+    [u'a', u'ab', u'abc']
+    >>> title_prefixes(u'e\u0301te\u0301', 2)
+    [u'e\u0301', u'e\u0301t']
+    >>> title_prefixes(u'te\u0301', 2)
+    [u't', u'te\u0301']
+
+    """
+    prefixes = []
+    for i, ch in enumerate(title):
+        if i and unicodedata.category(ch).startswith('M'):
+            prefixes[-1] = title[:i+1]
+        elif len(prefixes) < count:
+            prefixes.append(title[:i+1])
+        else:
+            break
+    return prefixes
+
+
+#number of leading title characters in jump table keys
+JUMP_TABLE_LEVELS = 3
+JUMP_TABLE_ENTRY_FORMAT = '>LL'
+
+class JumpTable(Section):
+    """
+    Maps primary strength collation keys of title prefixes
+    up to JUMP_TABLE_LEVELS characters long to ranges of
+    index items with such prefix.
+
+    """
+
+    name = 'jump_table'
+
+    def __init__(self):
+        self.seen = set()
+
+    def prefix_keys(self, title):
+        prefixes = title_prefixes(title.decode('utf8'), JUMP_TABLE_LEVELS)
+        for level, prefix in enumerate(prefixes, 1):
+            yield level, primary_collation_key(prefix).getByteArray()
+
+    def item_size(self, title):
+        #there are at most as many entries as distinct prefixes,
+        #their keys are only computed when section is built
+        size = 0
+        for prefix in title_prefixes(title.decode('utf8'), JUMP_TABLE_LEVELS):
+            if prefix not in self.seen:
+                self.seen.add(prefix)
+                size += (1 + estimated_key_len(prefix.encode('utf8'),
+                                               Collator.PRIMARY) +
+                         struct.calcsize(JUMP_TABLE_ENTRY_FORMAT))
+        return size
+
+    def build(self, volume, f):
+        levels = [{} for i in xrange(JUMP_TABLE_LEVELS)]
+        for i, title in enumerate(volume.sorted_titles()):
+            for level, key in self.prefix_keys(title):
+                entry = levels[level-1].setdefault(key, [i, i])
+                entry[1] = i + 1
+        f.write(struct.pack('>B', JUMP_TABLE_LEVELS))
+        for entries in levels:
+            f.write(struct.pack('>L', len(entries)))
+        for entries in levels:
+            for key, (start, end) in sorted(entries.iteritems()):
+                f.write(struct.pack('>B', len(key)))
+                f.write(key)
+                f.write(struct.pack(JUMP_TABLE_ENTRY_FORMAT, start, end))
+
+
+COLLATION_STRENGTHS = dict(primary=Collator.PRIMARY,
+                           secondary=Collator.SECONDARY,
+                           tertiary=Collator.TERTIARY,
+                           quaternary=Collator.QUATERNARY)
+
+class CollationKeys(Section):
+    """
+    ICU sort keys of all titles in index order at one or more
+    collation strengths.
+
+    """
+
+    name = 'collation_keys'
+
+    uses_sort_keys = True
+
+    def __init__(self, strengths):
+        self.strengths = sorted(COLLATION_STRENGTHS[strength]
+                                for strength in strengths)
+        self.key_funcs = []
+        for strength in self.strengths:
+            if strength == Collator.QUATERNARY:
+                self.key_funcs.append(collation_key)
+            else:
+                c = Collator.createInstance(Locale(''))
+                c.setStrength(strength)
+                self.key_funcs.append(c.getCollationKey)
+        #strength and block offset in section header and
+        #one more key offset than there are keys for each strength
+        self.fixed_size += 9*len(self.strengths)
+
+    def item_size(self, title):
+        #keys are only computed when section is built,
+        #space is reserved by title length
+        return sum(4 + estimated_key_len(title, strength)
+                   for strength in self.strengths)
+
+    def build(self, volume, f):
+        blocks = []
+        for strength, key_func in zip(self.strengths, self.key_funcs):
+            if strength == Collator.QUATERNARY:
+                keys = volume.sorted_keys()
+            else:
+                keys = (key_func(title).getByteArray()
+                        for title in volume.sorted_titles())
+            offsets, data = [tempfile.NamedTemporaryFile(prefix=prefix,
+                                                         dir=volume.work_dir,
+                                                         delete=False)
+                             for prefix in ('key_offsets', 'keys')]
+            offset = 0
+            for key in keys:
+                offsets.write(struct.pack('>L', offset))
+                data.write(key)
+                offset += len(key)
+            offsets.write(struct.pack('>L', offset))
+            blocks.append((strength, offsets, data))
+            offsets.close()
+            data.close()
+        f.write(struct.pack('>B', len(blocks)))
+        block_offset = 1 + 5*len(blocks)
+        for strength, offsets, data in blocks:
+            f.write(struct.pack('>BL', strength, block_offset))
+            block_offset += (os.path.getsize(offsets.name) +
+                             os.path.getsize(data.name))
+        for strength, offsets, data in blocks:
+            for temp in (offsets, data):
+                copy_file(temp.name, f, 1024*1024)
+                os.remove(temp.name)
+
+
+class BloomFilter(Section):
+    """
+    Bloom filter over primary strength collation keys of titles
+    with given false positive rate. Bit positions are derived
+    from md5 digest of the key: first and second 8 bytes are
+    big endian numbers h1 and h2, i-th position is
+    (h1 + i*h2) mod number of bits.
+
+    >>> positions(bloom_hashes('key'), 3, 1000)
+    [434, 751, 68]
+
+    """
+
+    name = 'bloom_filter'
+
+    def __init__(self, false_positive_rate):
+        self.bits_per_item = -math.log(false_positive_rate)/math.log(2)**2
+        self.hash_count = max(int(round(self.bits_per_item*math.log(2))), 1)
+        #header and rounding number of bits up
+        self.fixed_size += 6
+
+    def item_size(self, title):
+        return self.bits_per_item/8
+
+    def build(self, volume, f):
+        bit_count = max(int(math.ceil(volume.index_count*self.bits_per_item)),
+                        8)
+        bits = bytearray((bit_count + 7)/8)
+        for title in volume.sorted_titles():
+            key = primary_collation_key(title.decode('utf8')).getByteArray()
+            for pos in positions(bloom_hashes(key), self.hash_count,
+                                 bit_count):
+                bits[pos >> 3] |= 1 << (pos & 7)
+        f.write(struct.pack('>BL', self.hash_count, bit_count))
+        f.write(bits)
+
+
+def bloom_hashes(key):
+    return struct.unpack('>QQ', hashlib.md5(key).digest())
+
+def positions((h1, h2), count, bit_count):
+    return [int((h1 + i*h2) % bit_count) for i in xrange(count)]
+
+
+#resource references in articles
+RESOURCE_URI_PREFIX = 'aard-res:'
+RESOURCE_ENTRY_FORMAT = '>20sLL'
+DATA_URI_RE = re.compile(r'data:image/png;base64,([A-Za-z0-9+/]+=*)')
+
+def extract_resources(text):
+    """
+    Replace PNG images inlined as data URIs in text with references
+    to resources, return new text and list of (key, image data).
+
+    >>> text, resources = extract_resources(
+    ...     '<img src="data:image/png;base64,YWJj">' * 2)
+    >>> print text
+    <img src="aard-res:a9993e364706816aba3e25717850c26c9cd0d89d"><img src="aard-res:a9993e364706816aba3e25717850c26c9cd0d89d">
+    >>> [(key.encode('hex'), data) for key, data in resources]
+    [('a9993e364706816aba3e25717850c26c9cd0d89d', 'abc')]
+
+    """
+    resources = {}
+    def replace(m):
+        try:
+            data = base64.b64decode(m.group(1))
+        except TypeError:
+            return m.group(0)
+        key = hashlib.sha1(data).digest()
+        resources[key] = data
+        return RESOURCE_URI_PREFIX + key.encode('hex')
+    text = DATA_URI_RE.sub(replace, text)
+    return text, resources.items()
+
+
+class Resources(Section):
+    """
+    Resources referenced by articles, each stored once
+    and keyed by sha1 digest of its content.
+
+    """
+
+    name = 'resources'
+
+    def __init__(self):
+        self.entries = {}
+        self.data = None
+        self.data_len = 0
+
+    def open(self, work_dir):
+        self.data = tempfile.NamedTemporaryFile(prefix='resources',
+                                                dir=work_dir,
+                                                delete=False)
+
+    def item_size(self, title):
+        return 0
+
+    def size(self, resources):
+        return sum(struct.calcsize(RESOURCE_ENTRY_FORMAT) + len(data)
+                   for key, data in resources if key not in self.entries)
+
+    def add(self, resources):
+        for key, data in resources:
+            if key not in self.entries:
+                self.entries[key] = (self.data_len, len(data))
+                self.data.write(data)
+                self.data_len += len(data)
+
+    def build(self, volume, f):
+        self.data.close()
+        f.write(struct.pack('>L', len(self.entries)))
+        for key, (offset, length) in sorted(self.entries.iteritems()):
+            f.write(struct.pack(RESOURCE_ENTRY_FORMAT, key, offset, length))
+        copy_file(self.data.name, f, 1024*1024)
+        os.remove(self.data.name)
+
+
+#number of titles in front coded index 2 block
+FRONT_CODING_BLOCK = 16
+#front coded index 2 item may take this many bytes more
+#than plain item: shared prefix length is added
+FRONT_CODING_OVERHEAD = struct.calcsize(KEY_LENGTH_FORMAT)
+
+DEFAULT_SORT_MEMORY = 512*1024*1024
+#approximate memory taken by sort record in addition to collation key
+SORT_RECORD_OVERHEAD = 200
+#struct format of collation key length in sorted run
+#and sort keys files
+RUN_KEY_LENGTH_FORMAT = '>L'
+#offset in sort keys file is remembered for every Nth item
+SORT_KEYS_INTERVAL = 1024
+#records sorted to reorder articles: article pointer and item
+#number, then number of item first referencing an article,
+#record kind and article pointer or item number, and finally
+#item number and new article pointer
+REORDER_PTR_FORMAT = '>QQ'
+REORDER_FIRST_FORMAT = '>QBQ'
+REORDER_ARTICLE, REORDER_ITEM = 0, 1
+
+def sort_run((index1_name, index2_name, index1_item_format,
+              keys_name, keys_offset, start, end, run_name)):
+    """
+    Sort index 1 items from start to end by collation key of
+    their titles and write (key length, key, index 1 item) records
+    to run file. Keys precomputed by article source are read from
+    keys file, if any. Runs in worker processes.
+
+    """
+    index1_unit_len = struct.calcsize(index1_item_format)
+    klen_structsize = struct.calcsize(KEY_LENGTH_FORMAT)
+    if keys_name:
+        keys = open(keys_name, 'rb')
+        keys.seek(keys_offset)
+        stored_keys = read_keys(keys)
+    else:
+        keys = None
+        stored_keys = itertools.repeat('')
+    with open(index1_name) as fi1, open(index2_name) as fi2:
+        index1 = mmap.mmap(fi1.fileno(), 0, prot=mmap.PROT_READ)
+        index2 = mmap.mmap(fi2.fileno(), 0, prot=mmap.PROT_READ)
+        records = []
+        for i, key in itertools.izip(xrange(start, end), stored_keys):
+            index1_item = index1[i*index1_unit_len:(i+1)*index1_unit_len]
+            if not key:
+                index2_ptr = struct.unpack(index1_item_format, index1_item)[0]
+                key_start = index2_ptr + klen_structsize
+                strlen = struct.unpack(KEY_LENGTH_FORMAT,
+                                       index2[index2_ptr:key_start])[0]
+                title = index2[key_start:key_start+strlen]
+                key = collation_key(title).getByteArray()
+            records.append((key, index1_item))
+        index1.close()
+        index2.close()
+    if keys:
+        keys.close()
+    #key ties are broken by index 1 item which starts with
+    #index 2 pointer, so equal titles keep insertion order
+    records.sort()
+    with open(run_name, 'wb', 1024*1024) as f:
+        for key, index1_item in records:
+            f.write(struct.pack(RUN_KEY_LENGTH_FORMAT, len(key)))
+            f.write(key)
+            f.write(index1_item)
+    return run_name
+
+def read_keys(f):
+    klen_structsize = struct.calcsize(RUN_KEY_LENGTH_FORMAT)
+    while True:
+        s = f.read(klen_structsize)
+        if not s:
+            break
+        keylen = struct.unpack(RUN_KEY_LENGTH_FORMAT, s)[0]
+        yield f.read(keylen)
+
+def read_run(f, index1_unit_len):
+    klen_structsize = struct.calcsize(RUN_KEY_LENGTH_FORMAT)
+    while True:
+        s = f.read(klen_structsize)
+        if not s:
+            break
+        keylen = struct.unpack(RUN_KEY_LENGTH_FORMAT, s)[0]
+        key = f.read(keylen)
+        yield key, f.read(index1_unit_len)
+
+def sort_records(file_name, record_len, run_len, work_dir, prefix='run'):
+    """
+    Yield fixed length records of a file in byte order, sorting
+    runs of up to `run_len` records in memory and merging them.
+    Records packed big endian sort in numeric order.
+
+    """
+    run_files = []
+    try:
+        with open(file_name, 'rb') as f:
+            for data in iter(functools.partial(f.read, run_len*record_len),
+                             ''):
+                records = [data[i:i+record_len]
+                           for i in xrange(0, len(data), record_len)]
+                records.sort()
+                with tempfile.NamedTemporaryFile(prefix=prefix,
+                                                 dir=work_dir,
+                                                 delete=False) as run:
+                    run.write(''.join(records))
+                run_files.append(open(run.name, 'rb'))
+        runs = [iter(functools.partial(f.read, record_len), '')
+                for f in run_files]
+        for record in heapq.merge(*runs):
+            yield record
+    finally:
+        for f in run_files:
+            f.close()
+            os.remove(f.name)
+
+
+def reopen(file_name, length):
+    """
+    Open existing file for writing after its first `length`
+    bytes, anything after that is discarded
+    """
+    f = open(file_name, 'r+b')
+    f.truncate(length)
+    f.seek(length)
+    return f
+
+
 class Volume(object):
 
     class ExceedsMaxSize(Exception): pass
@@ -214,54 +887,356 @@ class Volume(object):
     number = 0
 
 
-    def __init__(self, dictionary_uuid, header_meta_len, max_file_size_, work_dir):
+    def __init__(self, dictionary_uuid, header_meta_len, max_file_size_, work_dir,
+                 block_size=0, sort_processes=1, sort_memory=DEFAULT_SORT_MEMORY,
+                 output_file_name=None, index_reserve=0, dedup_entries=0,
+                 presorted=False, reorder_articles=False, sections=(),
+                 front_coded_index=False, extent_size=0, state=None,
+                 retain_files=None, check_order=True):
+        """
+        If `index_reserve` is specified articles are written directly to
+        volume file named after `output_file_name`, starting at
+        `index_reserve` offset. Header, metadata and indexes are written
+        in front of them when volume is finalized and must fit
+        in the reserved space.
+
+        Up to `dedup_entries` payload digests are remembered
+        so that titles with identical payloads can share it,
+        digests that find no free slot replace older ones.
+
+        If `presorted` is true items are expected to be added in
+        collation order, index is only checked and not sorted again
+        when volume is finalized unless they turn out to be out of order.
+        If `check_order` is false order of presorted items is trusted
+        and not checked either.
+
+        Optional `sections` are built from sorted index and
+        written after articles.
+
+        If `front_coded_index` is true index 2 is written in
+        blocks of front coded titles (format version 3).
+
+        If `extent_size` is specified CRC32 checksums of extents
+        of this size are written to the last section.
+
+        If `reorder_articles` is true articles are rewritten in index
+        order when volume is finalized, this is not supported
+        together with `index_reserve`.
+
+        If `state` obtained from :meth:`checkpoint` is specified,
+        volume continues with temporary files it refers to, truncated
+        to their length at the checkpoint.
+
+        If `retain_files` list is specified, temporary files volume
+        state refers to are appended to it instead of being removed
+        when volume is finalized.
+
+        """
+        if state:
+            self.number = state['number']
+        else:
+            Volume.number += 1
+            self.number = Volume.number
         self.dictionary_uuid = dictionary_uuid
         self.header_meta_len = header_meta_len
         self.max_file_size = max_file_size_
         self.work_dir = work_dir
-        self.index1 = tempfile.NamedTemporaryFile(prefix='index1',
-                                                  dir=work_dir,
-                                                  delete=False)
-        log.info('Creating temporary index 1 file %s', self.index1.name)
-        self.index2 = tempfile.NamedTemporaryFile(prefix='index2',
-                                                  dir=work_dir,
-                                                  delete=False)
-        log.info('Creating temporary index 2 file %s', self.index2.name)
-        self.articles =  tempfile.NamedTemporaryFile(prefix='articles',
-                                                     dir=work_dir,
-                                                     delete=False)
-        log.info('Creating temporary articles file %s', self.articles.name)
-
+        self.index_reserve = index_reserve
+        self.dedup_entries = dedup_entries
+        self.retain_files = retain_files
+        self.payloads = PayloadTable(dedup_entries) if dedup_entries else None
+        if state:
+            self.index1 = reopen(state['index1'], state['index1Length'])
+            self.index2 = reopen(state['index2'], state['index2Length'])
+            log.info('Continuing with temporary index files %s, %s',
+                     self.index1.name, self.index2.name)
+        else:
+            self.index1 = tempfile.NamedTemporaryFile(prefix='index1',
+                                                      dir=work_dir,
+                                                      delete=False)
+            log.info('Creating temporary index 1 file %s', self.index1.name)
+            self.index2 = tempfile.NamedTemporaryFile(prefix='index2',
+                                                      dir=work_dir,
+                                                      delete=False)
+            log.info('Creating temporary index 2 file %s', self.index2.name)
+        if index_reserve:
+            self.file_name = '%s.%d' % (output_file_name, self.number)
+            if state:
+                if os.path.exists(self.file_name + '.articles'):
+                    #articles were being moved when volume
+                    #was finalized after the checkpoint
+                    os.rename(self.file_name + '.articles', self.file_name)
+                self.articles = reopen(self.file_name,
+                                       index_reserve + state['articles_len'])
+            else:
+                self.articles = open(self.file_name, 'w+b')
+                self.articles.seek(index_reserve)
+            log.info('Writing articles to %s at offset %d',
+                     self.file_name, index_reserve)
+        elif state:
+            self.file_name = None
+            self.articles = reopen(state['articles'], state['articles_len'])
+            log.info('Continuing with temporary articles file %s',
+                     self.articles.name)
+        else:
+            self.file_name = None
+            self.articles =  tempfile.NamedTemporaryFile(prefix='articles',
+                                                         dir=work_dir,
+                                                         delete=False)
+            log.info('Creating temporary articles file %s', self.articles.name)
+
+        #temporary files volume state refers to
+        self.state_files = set([self.index1.name, self.index2.name])
+        if not self.file_name:
+            self.state_files.add(self.articles.name)
         self.index1_sorted = None
+        self.presorted = presorted
+        self.check_order = check_order
+        self.reorder_articles = reorder_articles and not index_reserve
+        self.sections = sections
+        self.resources = None
+        for section in sections:
+            if isinstance(section, Resources):
+                section.open(work_dir)
+                self.resources = section
+        self.sort_keys = None
+        self.sections_len = sum(section.fixed_size for section in sections)
+        self.extent_size = extent_size
+        if extent_size:
+            self.sections_len += (Section.fixed_size +
+                                  ExtentChecksums.table_len(extent_size,
+                                                            max_file_size_))
+        self.sha1sum = None
+        self.sort_processes = sort_processes
+        self.sort_memory = sort_memory
+        self.keys = None
+        self.keys_len = 0
+        self.keys_count = 0
+        self.keys_offsets = []
+
+        self.block_size = block_size
+        self.block = []
+        self.block_len = 0
+        self.block_ptr = 0
+        self.version = 1
+        if block_size:
+            self.version = max(self.version, ARTICLE_BLOCKS_VERSION)
+            self.index1_item_format = INDEX1_ITEM_FORMAT + 'L'
+        else:
+            self.index1_item_format = INDEX1_ITEM_FORMAT
+        self.front_coded_index = front_coded_index
+        if front_coded_index:
+            self.version = max(self.version, FRONT_CODED_INDEX_VERSION)
 
         self.index1Length = 0
         self.index2Length = 0
         self.articles_len = 0
         self.index_count = 0
-        Volume.number += 1
+        if state:
+            self._restore(state)
+
+    def checkpoint(self):
+        """
+        Flush temporary files to disk and return JSON serializable
+        state volume can be recreated from. Pending block must be
+        flushed before.
+
+        """
+        assert not self.block
+        files = [self.index1, self.index2, self.articles]
+        if self.keys:
+            files.append(self.keys)
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+        return dict(number=self.number,
+                    index1=self.index1.name,
+                    index2=self.index2.name,
+                    articles=None if self.file_name else self.articles.name,
+                    keys=self.keys.name if self.keys else None,
+                    index1Length=self.index1Length,
+                    index2Length=self.index2Length,
+                    articles_len=self.articles_len,
+                    index_count=self.index_count,
+                    keys_len=self.keys_len,
+                    keys_count=self.keys_count,
+                    keys_offsets=self.keys_offsets,
+                    sections_len=self.sections_len)
+
+    def _restore(self, state):
+        for name in ('index1Length', 'index2Length', 'articles_len',
+                     'index_count', 'keys_len', 'keys_count',
+                     'keys_offsets', 'sections_len'):
+            setattr(self, name, state[name])
+        if state['keys']:
+            self.keys = reopen(state['keys'], self.keys_len)
+            self.state_files.add(self.keys.name)
+
+    def _remove(self, name):
+        if self.retain_files is not None and name in self.state_files:
+            log.info('Keeping temp file %s until next checkpoint', name)
+            self.retain_files.append(name)
+        else:
+            log.info('Removing temp file %s', name)
+            os.remove(name)
 
 
-    def add(self, title, serialized_article):
-        index1Unit = struct.pack(INDEX1_ITEM_FORMAT,
-                                 self.index2Length,
-                                 self.articles_len)
+    def add(self, title, serialized_article, sort_key=None, digest=None):
+        self.flush_block()
+        location = (self.articles_len, NO_BLOCK)
+        index1Unit = self._pack_index1(*location)
         index2Unit = struct.pack(KEY_LENGTH_FORMAT, len(title)) + title
         article_unit = (struct.pack(ARTICLE_LENGTH_FORMAT,
                                    len(serialized_article)) +
                         serialized_article)
-        self._add(index1Unit, index2Unit, article_unit)
-
-
-    def _add(self, index1_unit, index2_unit, article_unit):
-        if sum((self.header_meta_len,
-                self.index1Length,
-                self.index2Length,
-                self.articles_len,
-                len(index1_unit),
-                len(index2_unit),
-                len(article_unit)
-                )) > self.max_file_size:
+        self._add(index1Unit, index2Unit, article_unit, sort_key=sort_key)
+        self._remember_payload(digest, location)
+
+    def add_ref(self, title, location, sort_key=None):
+        """
+        Add title pointing to payload already in this volume
+        """
+        index1Unit = self._pack_index1(*location)
+        index2Unit = struct.pack(KEY_LENGTH_FORMAT, len(title)) + title
+        self._add(index1Unit, index2Unit, '', sort_key=sort_key)
+
+    def payload_location(self, digest):
+        """
+        Return (article pointer, in-block offset) of payload
+        with given digest or None if it's not in this volume
+        """
+        if self.payloads:
+            return self.payloads.get(digest)
+
+    def _remember_payload(self, digest, location):
+        if digest and self.payloads:
+            self.payloads.add(digest, location)
+
+    def add_to_block(self, title, serialized_article, digest=None):
+        """
+        Add uncompressed article to the block of small articles,
+        block is compressed and written once it reaches block size
+        or when article that is not in a block is added.
+
+        """
+        if not self.block:
+            self.block_ptr = self.articles_len
+        location = (self.block_ptr, self.block_len)
+        index1Unit = self._pack_index1(*location)
+        index2Unit = struct.pack(KEY_LENGTH_FORMAT, len(title)) + title
+        block_unit = (struct.pack(ARTICLE_LENGTH_FORMAT,
+                                  len(serialized_article)) +
+                      serialized_article)
+        self._add(index1Unit, index2Unit, '', len(block_unit))
+        self._remember_payload(digest, location)
+        self.block.append(block_unit)
+        self.block_len += len(block_unit)
+        if self.block_len >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self):
+        if not self.block:
+            return
+        compressed = self._compress_block(''.join(self.block))
+        self.block = []
+        self.block_len = 0
+        article_unit = (struct.pack(ARTICLE_LENGTH_FORMAT, len(compressed)) +
+                        compressed)
+        self.articles.write(article_unit)
+        self.articles_len += len(article_unit)
+
+    def _compress_block(self, block):
+        #blocks are never compressed against preset dictionary
+        return compress(block, BASE_CODECS)
+
+    def _pack_index1(self, article_ptr, block_offset):
+        if self.block_size:
+            return struct.pack(self.index1_item_format,
+                               self.index2Length, article_ptr, block_offset)
+        return struct.pack(self.index1_item_format,
+                           self.index2Length, article_ptr)
+
+    def _pending_block_len(self, block_unit_len):
+        #pending block is accounted for uncompressed,
+        #compressed block is never bigger
+        if not (self.block or block_unit_len):
+            return 0
+        return (struct.calcsize(ARTICLE_LENGTH_FORMAT) +
+                self.block_len + block_unit_len)
+
+    def _add_sort_key(self, sort_key):
+        """
+        Record precomputed collation key for the item being added,
+        keys file is only created once first key is supplied
+        """
+        if self.keys is None:
+            if sort_key is None:
+                return
+            self.keys = tempfile.NamedTemporaryFile(prefix='keys',
+                                                    dir=self.work_dir,
+                                                    delete=False)
+            log.info('Creating temporary sort keys file %s', self.keys.name)
+            self.state_files.add(self.keys.name)
+            for i in xrange(self.index_count):
+                self._write_sort_key('')
+        self._write_sort_key(sort_key or '')
+
+    def _write_sort_key(self, sort_key):
+        if len(self.keys_offsets)*SORT_KEYS_INTERVAL == self.keys_count:
+            self.keys_offsets.append(self.keys_len)
+        self.keys.write(struct.pack(RUN_KEY_LENGTH_FORMAT, len(sort_key)))
+        self.keys.write(sort_key)
+        self.keys_len += struct.calcsize(RUN_KEY_LENGTH_FORMAT) + len(sort_key)
+        self.keys_count += 1
+
+    def add_resources(self, resources):
+        """
+        Add (key, data) resources referenced by article
+        that is about to be added, unless already added
+        """
+        size = self.resources.size(resources)
+        if size:
+            self._check_size(self._index_len(),
+                             sum((self.articles_len,
+                                  self._pending_block_len(0),
+                                  self.sections_len,
+                                  size)))
+            self.resources.add(resources)
+            self.sections_len += size
+
+    def _index_len(self, item_len=0):
+        index_len = sum((self.header_meta_len,
+                         self.index1Length,
+                         self.index2Length,
+                         item_len))
+        if self.front_coded_index:
+            #front coded item is at most this much longer
+            index_len += (self.index_count + 1)*FRONT_CODING_OVERHEAD
+        return index_len
+
+    def _check_size(self, index_len, articles_len):
+        if self.index_reserve:
+            if (index_len > self.index_reserve or
+                self.index_reserve + articles_len > self.max_file_size):
+                raise Volume.ExceedsMaxSize
+        elif index_len + articles_len > self.max_file_size:
             raise Volume.ExceedsMaxSize
+
+    def _add(self, index1_unit, index2_unit, article_unit, block_unit_len=0,
+             sort_key=None):
+        index_len = self._index_len(len(index1_unit) + len(index2_unit))
+        sections_len = self.sections_len
+        if self.sections:
+            title = index2_unit[struct.calcsize(KEY_LENGTH_FORMAT):]
+            sections_len += sum(section.item_size(title)
+                                for section in self.sections)
+        articles_len = sum((self.articles_len,
+                            self._pending_block_len(block_unit_len),
+                            len(article_unit),
+                            sections_len))
+        self._check_size(index_len, articles_len)
+        self.sections_len = sections_len
+        self._add_sort_key(sort_key)
         self.index1.write(index1_unit)
         self.index1Length += len(index1_unit)
         self.index2.write(index2_unit)
@@ -276,94 +1251,478 @@ class Volume(object):
                                                     dir=self.work_dir,
                                                     delete=False)
         self.index1_sorted = index1_sorted
-        index1_unit_len = struct.calcsize(INDEX1_ITEM_FORMAT)
-        klen_structsize = struct.calcsize(KEY_LENGTH_FORMAT)
-
-        key = lambda x: collation_key(x).getByteArray()
-
-        with open(self.index1.name) as fi1, open(self.index2.name) as fi2:
-
-            index1 = mmap.mmap(fi1.fileno(), 0, prot=mmap.PROT_READ)
-            index2 = mmap.mmap(fi2.fileno(), 0, prot=mmap.PROT_READ)
-
-            index_item_count = len(index1)/index1_unit_len
-
-            def read_packed_index1_item(i):
-                pos_start = i*index1_unit_len
-                pos_end = pos_start + index1_unit_len
-                return index1[pos_start:pos_end]
-
-            def index1_item_at(i):
-                return struct.unpack(INDEX1_ITEM_FORMAT,
-                                     read_packed_index1_item(i))
-
-            def read_key(pos):
-                start = pos+klen_structsize
-                s = index2[pos:start]
-                strlen = struct.unpack(KEY_LENGTH_FORMAT, s)[0]
-                return index2[start:start+strlen]
+        index1_unit_len = struct.calcsize(self.index1_item_format)
+        index_item_count = self.index1Length/index1_unit_len
+
+        avg_title_len = float(self.index2Length)/max(index_item_count, 1)
+        record_size = SORT_RECORD_OVERHEAD + 4*avg_title_len
+        processes = max(self.sort_processes, 1)
+        run_len = max(int(self.sort_memory/(processes*record_size)), 1000)
+        #runs start at items with known offset in sort keys file
+        run_len += -run_len % SORT_KEYS_INTERVAL
+
+        keys_name = self.keys.name if self.keys else None
+        runs = [(self.index1.name, self.index2.name, self.index1_item_format,
+                 keys_name,
+                 self.keys_offsets[start/SORT_KEYS_INTERVAL] if keys_name else 0,
+                 start, min(start + run_len, index_item_count),
+                 '%s-run%d' % (index1_sorted.name, i))
+                for i, start in enumerate(xrange(0, index_item_count, run_len))]
+        log.info('Sorting %d index items in %d run(s) of up to %d items '
+                 'with %d process(es)',
+                 index_item_count, len(runs), run_len, processes)
+        if processes > 1 and len(runs) > 1:
+            pool = multiprocessing.Pool(min(processes, len(runs)))
+            try:
+                run_names = pool.map(sort_run, runs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            run_names = [sort_run(run) for run in runs]
 
-            def realkey(x):
-                index_item = index1_item_at(x)
-                index2_ptr = index_item[0]
-                title = read_key(index2_ptr)
-                return key(title)
+        if any(section.uses_sort_keys for section in self.sections):
+            sort_keys = tempfile.NamedTemporaryFile(prefix='sort_keys',
+                                                    dir=self.work_dir,
+                                                    delete=False)
+            log.info('Keeping sort keys in %s', sort_keys.name)
+            self.sort_keys = sort_keys.name
+        else:
+            sort_keys = None
+        run_files = [open(name, 'rb') for name in run_names]
+        try:
+            merged = heapq.merge(*[read_run(f, index1_unit_len)
+                                   for f in run_files])
+            for key, index1_item in merged:
+                index1_sorted.write(index1_item)
+                if sort_keys:
+                    sort_keys.write(struct.pack(RUN_KEY_LENGTH_FORMAT,
+                                                len(key)))
+                    sort_keys.write(key)
+        finally:
+            for f in run_files:
+                f.close()
+                os.remove(f.name)
+            if sort_keys:
+                sort_keys.close()
+
+        index1_sorted.close()
+        log.info("Index sorted")
+        self._remove(self.index1.name)
+        if keys_name:
+            self._remove(keys_name)
+
+    def _in_collation_order(self):
+        """
+        Tell whether items were added in collation order of their
+        titles, as promised when volume was created. Collation keys
+        are kept if any section uses them, as when index is sorted.
+        Order is not checked if volume was created with `check_order`
+        false, keys are then only computed if some section needs them.
 
-            def sorted_index1_items():
-                for i in sorted(xrange(index_item_count), key=realkey):
-                    yield read_packed_index1_item(i)
+        """
+        self.index1_sorted = self.index1
+        if any(section.uses_sort_keys for section in self.sections):
+            sort_keys = tempfile.NamedTemporaryFile(prefix='sort_keys',
+                                                    dir=self.work_dir,
+                                                    delete=False)
+        elif not self.check_order:
+            if self.keys:
+                self._remove(self.keys.name)
+            return True
+        else:
+            sort_keys = None
+        keys = open(self.keys.name, 'rb') if self.keys else None
+        stored_keys = read_keys(keys) if keys else itertools.repeat('')
+        in_order = True
+        previous = ''
+        try:
+            for title, key in itertools.izip(self.sorted_titles(),
+                                             stored_keys):
+                if not key:
+                    key = collation_key(title).getByteArray()
+                if self.check_order and key < previous:
+                    in_order = False
+                    break
+                previous = key
+                if sort_keys:
+                    sort_keys.write(struct.pack(RUN_KEY_LENGTH_FORMAT,
+                                                len(key)))
+                    sort_keys.write(key)
+        finally:
+            if keys:
+                keys.close()
+            if sort_keys:
+                sort_keys.close()
+        if not in_order:
+            log.warn('Volume %d items were not added in collation order '
+                     'of titles, sorting index', self.number)
+            self.index1_sorted = None
+            if sort_keys:
+                os.remove(sort_keys.name)
+            return False
+        if sort_keys:
+            self.sort_keys = sort_keys.name
+        if keys:
+            self._remove(keys.name)
+        return True
 
-            for index1_item in sorted_index1_items():
-                index1_sorted.write(index1_item)
+    def _reorder_articles(self):
+        """
+        Rewrite articles file so that articles follow in sorted index
+        order. Articles and blocks referenced by several index items
+        are written once, where first referenced. Article pointers
+        of all items are sorted in files rather than kept in memory.
 
-            index1_sorted.close()
-        log.info("Index sorted, removing temp file %s", self.index1.name)
-        os.remove(self.index1.name)
+        """
+        self.articles.close()
+        index1_unit_len = struct.calcsize(self.index1_item_format)
+        alen_structsize = struct.calcsize(ARTICLE_LENGTH_FORMAT)
+        log.info('Reordering articles')
+
+        def temp_file(prefix):
+            return tempfile.NamedTemporaryFile(prefix=prefix,
+                                               dir=self.work_dir,
+                                               delete=False)
+
+        def run_len(record_format):
+            return max(int(self.sort_memory/(SORT_RECORD_OVERHEAD +
+                                             struct.calcsize(record_format))),
+                       1000)
+
+        def index1_items():
+            with open(self.index1_sorted.name, 'rb') as fi1:
+                for index1_item in iter(functools.partial(fi1.read,
+                                                          index1_unit_len),
+                                        ''):
+                    yield list(struct.unpack(self.index1_item_format,
+                                             index1_item))
+
+        #article pointer of each item
+        ptrs = temp_file('reorder_ptrs')
+        with ptrs:
+            for i, values in enumerate(index1_items()):
+                ptrs.write(struct.pack(REORDER_PTR_FORMAT, values[1], i))
+
+        #items grouped by article, each article is
+        #keyed by the first item referencing it
+        firsts = temp_file('reorder_firsts')
+        with firsts:
+            article_ptr = first = None
+            for record in sort_records(ptrs.name,
+                                       struct.calcsize(REORDER_PTR_FORMAT),
+                                       run_len(REORDER_PTR_FORMAT),
+                                       self.work_dir, 'reorder_run'):
+                ptr, i = struct.unpack(REORDER_PTR_FORMAT, record)
+                if ptr != article_ptr:
+                    article_ptr, first = ptr, i
+                    firsts.write(struct.pack(REORDER_FIRST_FORMAT, first,
+                                             REORDER_ARTICLE, ptr))
+                firsts.write(struct.pack(REORDER_FIRST_FORMAT, first,
+                                         REORDER_ITEM, i))
+        os.remove(ptrs.name)
+
+        #articles in order of first reference,
+        #followed by new pointers of items referencing them
+        articles_sorted = temp_file('articles_sorted')
+        new_ptrs = temp_file('reorder_new_ptrs')
+        new_len = 0
+        with open(self.articles.name, 'rb') as fa, articles_sorted, new_ptrs:
+            articles = mmap.mmap(fa.fileno(), 0, prot=mmap.PROT_READ)
+            for record in sort_records(firsts.name,
+                                       struct.calcsize(REORDER_FIRST_FORMAT),
+                                       run_len(REORDER_FIRST_FORMAT),
+                                       self.work_dir, 'reorder_run'):
+                _first, kind, value = struct.unpack(REORDER_FIRST_FORMAT,
+                                                    record)
+                if kind == REORDER_ARTICLE:
+                    new_ptr = new_len
+                    length = struct.unpack(
+                        ARTICLE_LENGTH_FORMAT,
+                        articles[value:value+alen_structsize])[0]
+                    article_unit = articles[value:
+                                            value+alen_structsize+length]
+                    articles_sorted.write(article_unit)
+                    new_len += len(article_unit)
+                else:
+                    new_ptrs.write(struct.pack(REORDER_PTR_FORMAT,
+                                               value, new_ptr))
+            articles.close()
+        os.remove(firsts.name)
+        log.info('Reordered articles into %s', articles_sorted.name)
+
+        index1_reordered = temp_file('index1_reordered')
+        with index1_reordered:
+            sorted_new_ptrs = sort_records(new_ptrs.name,
+                                           struct.calcsize(REORDER_PTR_FORMAT),
+                                           run_len(REORDER_PTR_FORMAT),
+                                           self.work_dir, 'reorder_run')
+            for values, record in itertools.izip(index1_items(),
+                                                 sorted_new_ptrs):
+                values[1] = struct.unpack(REORDER_PTR_FORMAT, record)[1]
+                index1_reordered.write(struct.pack(self.index1_item_format,
+                                                   *values))
+        os.remove(new_ptrs.name)
+        for f in (self.articles, self.index1_sorted):
+            self._remove(f.name)
+        self.articles = articles_sorted
+        self.index1_sorted = index1_reordered
 
     #FIXME currently metadata is processed after all articles collected
     #but now we want to create Volume right away, so we need to know
     #metadata length before we start with articles... sort of - that's only
     #to detect when we exceed desired volume size
-    def finalize(self, output_file_name, serialized_metadata):
+    def finalize(self, output_file_name, metadata, volume_count=0):
+        """
+        Write volume file and return its name. If total number of volumes
+        is known, it is written to the header and sha1 sum is calculated
+        while the file is written, volume's `sha1sum` is set then.
+        Location of optional sections is added to `metadata`.
+
+        """
+        self.flush_block()
+        if self.keys:
+            self.keys.close()
         self.index1.close()
         self.index2.close()
-        self.articles.close()
-        self._sort()
-        file_name = '%s.%d' % (output_file_name, Volume.number)
+        if not (self.presorted and self._in_collation_order()):
+            self._sort()
+        if self.reorder_articles and self.articles_len:
+            self._reorder_articles()
+        sections = self._build_sections()
+        if sections:
+            metadata['sections'] = section_offsets = {}
+            offset = self.articles_len
+            for section, f, length in sections:
+                section_offsets[section.name] = [offset, length]
+                offset += length
+        if self.front_coded_index:
+            self._front_code_index()
+            metadata['front_coding_block'] = FRONT_CODING_BLOCK
+        if 'preset_dictionary' in metadata:
+            self.version = max(self.version, PRESET_DICTIONARY_VERSION)
+        if self.extent_size:
+            serialized_metadata = self._serialize_with_checksums(metadata,
+                                                                 sections)
+        else:
+            serialized_metadata = serialize_metadata(metadata)
         buf_size = 1024*1024
-        with open(file_name, "wb", buf_size) as output_file:
-            self.write_header_and_meta(output_file, serialized_metadata)
-            for fname in (self.index1_sorted.name, self.index2.name, self.articles.name):
-                with open(fname) as f:
-                    while True:
-                        data = f.read(buf_size)
-                        if len(data) == 0:
-                            break
-                        output_file.write(data)
+        prefix_len = self._prefix_len(serialized_metadata)
+        articles_offset = 0
+        if self.index_reserve and prefix_len > self.index_reserve:
+            #metadata turned out bigger than estimated,
+            #articles need to be moved after all
+            log.warn('Volume %d header, metadata and index take %d bytes, '
+                     'more than %d reserved, copying articles',
+                     self.number, prefix_len, self.index_reserve)
+            self.articles.close()
+            self.state_files.add(self.file_name + '.articles')
+            os.rename(self.file_name, self.file_name + '.articles')
+            self.articles = open(self.file_name + '.articles')
+            articles_offset = self.index_reserve
+            self.index_reserve = 0
+        if self.index_reserve:
+            file_name = self.file_name
+            out = self.articles
+            out.flush()
+            out.seek(0)
+        else:
+            self.articles.close()
+            file_name = '%s.%d' % (output_file_name, self.number)
+            out = open(file_name, "wb", buf_size)
+        with out:
+            extents = (ExtentChecksums(self.extent_size)
+                       if self.extent_size else None)
+            output_file = ChecksumWriter(out, spec_len(HEADER_SPEC[:2]),
+                                         extents, spec_len(HEADER_SPEC))
+            self.write_header_and_meta(output_file, serialized_metadata,
+                                       volume_count)
+            for fname in (self.index1_sorted.name, self.index2.name):
+                copy_file(fname, output_file, buf_size)
+            if self.index_reserve:
+                output_file.write('\0'*(self.index_reserve - prefix_len))
+                if volume_count or extents:
+                    #articles are already in place, read them
+                    #back to finish calculating checksum
+                    out.seek(self.index_reserve)
+                    for data in iter(functools.partial(out.read, buf_size), ''):
+                        output_file.update(data)
+            else:
+                copy_file(self.articles.name, output_file, buf_size,
+                          articles_offset)
+            if self.index_reserve:
+                out.seek(self.index_reserve + self.articles_len)
+            for section, f, length in sections:
+                copy_file(f.name, output_file, buf_size)
+            if extents:
+                table = extents.table()
+                output_file.write(table)
+                output_file.write('\0'*(self.extent_table_len - len(table)))
+            if volume_count:
+                self.sha1sum = output_file.sha1.hexdigest()
+                out.seek(spec_len(HEADER_SPEC[:1]))
+                out.write(self.sha1sum)
         log.info("Done with %s", file_name)
-        log.info("Removing temp file %s", self.index1_sorted.name)
-        os.remove(self.index1_sorted.name)
-        log.info("Removing temp file %s", self.index2.name)
-        os.remove(self.index2.name)
-        log.info("Removing temp file %s", self.articles.name)
-        os.remove(self.articles.name)
+        self._remove(self.index1_sorted.name)
+        self._remove(self.index2.name)
+        if not self.index_reserve:
+            self._remove(self.articles.name)
+        for section, f, length in sections:
+            self._remove(f.name)
+        if self.sort_keys:
+            self._remove(self.sort_keys)
         return file_name
 
-    def write_header_and_meta(self, output_file, serialized_metadata):
+    def _prefix_len(self, serialized_metadata):
+        return (spec_len(HEADER_SPEC) + len(serialized_metadata) +
+                self.index1Length + self.index2Length)
+
+    def _serialize_with_checksums(self, metadata, sections):
+        """
+        Serialize metadata with location of extent checksums section,
+        which covers everything between header and this section,
+        including metadata itself
+        """
+        sections_len = sum(length for section, f, length in sections)
+        section_offsets = metadata.setdefault('sections', {})
+        length = 0
+        while True:
+            section_offsets[EXTENT_CHECKSUMS] = [
+                self.articles_len + sections_len, length]
+            serialized_metadata = serialize_metadata(metadata)
+            prefix_len = self._prefix_len(serialized_metadata)
+            if self.index_reserve and prefix_len <= self.index_reserve:
+                article_offset = self.index_reserve
+            else:
+                article_offset = prefix_len
+            covered_len = (article_offset - spec_len(HEADER_SPEC) +
+                           self.articles_len + sections_len)
+            table_len = ExtentChecksums.table_len(self.extent_size,
+                                                  covered_len)
+            if table_len <= length:
+                #table is padded to declared length if
+                #longer metadata turned out to compress better
+                self.extent_table_len = length
+                return serialized_metadata
+            length = table_len
+
+    def _build_sections(self):
+        """
+        Write optional sections to temporary files, return list of
+        (section, file, length)
+        """
+        sections = []
+        for section in self.sections:
+            f = tempfile.NamedTemporaryFile(prefix='section_%s' % section.name,
+                                            dir=self.work_dir,
+                                            delete=False)
+            log.info('Building %s section in %s', section.name, f.name)
+            with f:
+                section.build(self, f)
+                length = f.tell()
+            sections.append((section, f, length))
+        return sections
+
+    def sorted_titles(self):
+        """
+        Iterate over titles in sorted index order,
+        index must already be sorted
+        """
+        for index1_item, title in self._sorted_items():
+            yield title
+
+    def _sorted_items(self):
+        index1_unit_len = struct.calcsize(self.index1_item_format)
+        klen_structsize = struct.calcsize(KEY_LENGTH_FORMAT)
+        with open(self.index1_sorted.name, 'rb') as fi1, \
+                open(self.index2.name, 'rb') as fi2:
+            for index1_item in iter(functools.partial(fi1.read,
+                                                      index1_unit_len), ''):
+                index2_ptr = struct.unpack(self.index1_item_format,
+                                           index1_item)[0]
+                fi2.seek(index2_ptr)
+                strlen = struct.unpack(KEY_LENGTH_FORMAT,
+                                       fi2.read(klen_structsize))[0]
+                yield index1_item, fi2.read(strlen)
+
+    def _front_code_index(self):
+        """
+        Rewrite index 2 in sorted order as blocks of
+        FRONT_CODING_BLOCK titles, each title except the first one
+        in a block stored as length of prefix shared with previous
+        title followed by the rest of the title. Index 1 items
+        point to the block of their title.
+
+        """
+        index1_coded = tempfile.NamedTemporaryFile(prefix='index1_coded',
+                                                   dir=self.work_dir,
+                                                   delete=False)
+        index2_coded = tempfile.NamedTemporaryFile(prefix='index2_coded',
+                                                   dir=self.work_dir,
+                                                   delete=False)
+        log.info('Front coding index into %s', index2_coded.name)
+        index2_len = 0
+        block_ptr = 0
+        previous = ''
+        for i, (index1_item, title) in enumerate(self._sorted_items()):
+            if i % FRONT_CODING_BLOCK == 0:
+                block_ptr = index2_len
+                index2_unit = (struct.pack(KEY_LENGTH_FORMAT, len(title)) +
+                               title)
+            else:
+                shared = len(os.path.commonprefix((previous, title)))
+                index2_unit = (struct.pack(KEY_LENGTH_FORMAT, shared) +
+                               struct.pack(KEY_LENGTH_FORMAT,
+                                           len(title) - shared) +
+                               title[shared:])
+            values = list(struct.unpack(self.index1_item_format,
+                                        index1_item))
+            values[0] = block_ptr
+            index1_coded.write(struct.pack(self.index1_item_format, *values))
+            index2_coded.write(index2_unit)
+            index2_len += len(index2_unit)
+            previous = title
+        index1_coded.close()
+        index2_coded.close()
+        for f in (self.index1_sorted, self.index2):
+            self._remove(f.name)
+        self.index1_sorted = index1_coded
+        self.index2 = index2_coded
+        self.index2Length = index2_len
+
+    def sorted_keys(self):
+        """
+        Iterate over collation keys in sorted index order,
+        keys computed when index was sorted are reused if
+        any section requested it
+        """
+        if self.sort_keys:
+            with open(self.sort_keys, 'rb') as f:
+                for key in read_keys(f):
+                    yield key
+        else:
+            for title in self.sorted_titles():
+                yield collation_key(title).getByteArray()
+
+    def write_header_and_meta(self, output_file, serialized_metadata,
+                              volume_count=0):
         meta_length = len(serialized_metadata)
-        article_offset = (spec_len(HEADER_SPEC) + meta_length +
-                          self.index1Length + self.index2Length)
+        if self.index_reserve:
+            article_offset = self.index_reserve
+        else:
+            article_offset = (spec_len(HEADER_SPEC) + meta_length +
+                              self.index1Length + self.index2Length)
         values = dict(signature='aard',
                       sha1sum='0'*40,
-                      version=1,
+                      version=self.version,
                       uuid=self.dictionary_uuid.bytes,
                       volume=self.number,
-                      of=0,
-                      total_volumes=0,
+                      of=volume_count,
+                      total_volumes=volume_count,
                       meta_length=meta_length,
                       index_count=self.index_count,
                       article_offset=article_offset,
-                      index1_item_format=INDEX1_ITEM_FORMAT,
+                      index1_item_format=self.index1_item_format,
                       key_length_format=KEY_LENGTH_FORMAT,
                       article_length_format=ARTICLE_LENGTH_FORMAT)
         for name, fmt in HEADER_SPEC:
@@ -371,8 +1730,699 @@ class Volume(object):
         output_file.write(serialized_metadata)
 
 
-import threading
-article_add_lock = threading.RLock()
+class StagingVolume(Volume):
+    """
+    Unbounded volume holding all articles of a dictionary until
+    they can be sorted and partitioned into volumes covering
+    contiguous title ranges. Blocks are kept uncompressed
+    and each index 2 item is followed by a flag byte that
+    is set for items counted as articles, caller sets `counted`
+    before adding an item.
+
+    """
+
+    def __init__(self, dictionary_uuid, work_dir, **kwargs):
+        Volume.__init__(self, dictionary_uuid, 0, sys.maxsize, work_dir,
+                        **kwargs)
+        #staging volume doesn't become a volume file
+        Volume.number -= 1
+        self.number = 0
+        self.index1_item_format = '>LQ' + ('L' if self.block_size else '')
+        self.counted = False
+        self.max_title_len = 0
+        #locations of payloads shared by more than one title
+        self.shared = set()
+
+    def add_ref(self, title, location, sort_key=None):
+        Volume.add_ref(self, title, location, sort_key=sort_key)
+        self.shared.add(location)
+
+    def _compress_block(self, block):
+        return block
+
+    def _add(self, index1_unit, index2_unit, article_unit, block_unit_len=0,
+             sort_key=None):
+        self.max_title_len = max(self.max_title_len, len(index2_unit))
+        index2_unit += '\1' if self.counted else '\0'
+        Volume._add(self, index1_unit, index2_unit, article_unit,
+                    block_unit_len, sort_key)
+
+    def sorted_items(self):
+        """
+        Sort staged items and yield (title, counted, location, payload)
+        in collation order. Payload is compressed article for items
+        not in a block and uncompressed article text otherwise.
+
+        """
+        self.flush_block()
+        for f in filter(None, (self.keys, self.index1, self.index2,
+                               self.articles)):
+            f.close()
+        self._sort()
+        index1_unit_len = struct.calcsize(self.index1_item_format)
+        klen_structsize = struct.calcsize(KEY_LENGTH_FORMAT)
+        alen_structsize = struct.calcsize(ARTICLE_LENGTH_FORMAT)
+        names = (self.index1_sorted.name, self.index2.name,
+                 self.articles.name)
+        files = [open(name, 'rb') for name in names]
+        maps = []
+        try:
+            if self.index_count:
+                maps = [mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+                        for f in files]
+                index1, index2, articles = maps
+            for i in xrange(self.index_count):
+                item = struct.unpack(
+                    self.index1_item_format,
+                    index1[i*index1_unit_len:(i+1)*index1_unit_len])
+                index2_ptr, article_ptr = item[:2]
+                block_offset = item[2] if self.block_size else NO_BLOCK
+                key_start = index2_ptr + klen_structsize
+                strlen = struct.unpack(KEY_LENGTH_FORMAT,
+                                       index2[index2_ptr:key_start])[0]
+                title = index2[key_start:key_start+strlen]
+                counted = index2[key_start+strlen] == '\1'
+                if block_offset == NO_BLOCK:
+                    start = article_ptr
+                else:
+                    start = (article_ptr + alen_structsize +
+                             block_offset)
+                length = struct.unpack(
+                    ARTICLE_LENGTH_FORMAT,
+                    articles[start:start+alen_structsize])[0]
+                payload = articles[start+alen_structsize:
+                                   start+alen_structsize+length]
+                yield title, counted, (article_ptr, block_offset), payload
+        finally:
+            for m in maps:
+                m.close()
+            for f in files:
+                f.close()
+            for name in names:
+                log.info("Removing temp file %s", name)
+                os.remove(name)
+
+
+class VolumeReader(object):
+    """
+    Read access to index and stored articles of a volume file
+    of any format version, file is mapped to memory.
+
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.f = open(file_name, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, prot=mmap.PROT_READ)
+        self.header = header = {}
+        pos = 0
+        for name, fmt in HEADER_SPEC:
+            size = struct.calcsize(fmt)
+            header[name] = struct.unpack(fmt, self.data[pos:pos+size])[0]
+            pos += size
+        meta_length = header['meta_length']
+        self.metadata = json.loads(decompress(self.data[pos:pos+meta_length]))
+        pos += meta_length
+        self.version = header['version']
+        self.index_count = header['index_count']
+        self.index1_item_format = header['index1_item_format'].rstrip('\0')
+        self.index1_unit_len = struct.calcsize(self.index1_item_format)
+        self.index1_offset = pos
+        self.index2_offset = pos + self.index_count*self.index1_unit_len
+        self.article_offset = header['article_offset']
+        self.front_coding_block = self.metadata.get('front_coding_block')
+        prefix = self.metadata.get('preset_dictionary')
+        self.preset_prefix = base64.b64decode(prefix) if prefix else None
+        self.klen_structsize = struct.calcsize(KEY_LENGTH_FORMAT)
+        self.alen_structsize = struct.calcsize(ARTICLE_LENGTH_FORMAT)
+        #last decompressed block
+        self.block = (None, None)
+
+    def __len__(self):
+        return self.index_count
+
+    def item(self, i):
+        """
+        Return (index 2 pointer, article pointer, block offset)
+        of i-th index item
+        """
+        start = self.index1_offset + i*self.index1_unit_len
+        values = struct.unpack(self.index1_item_format,
+                               self.data[start:start+self.index1_unit_len])
+        if len(values) == 2:
+            return values + (NO_BLOCK,)
+        return values
+
+    def _key(self, pos):
+        strlen = struct.unpack(KEY_LENGTH_FORMAT,
+                               self.data[pos:pos+self.klen_structsize])[0]
+        pos += self.klen_structsize
+        return self.data[pos:pos+strlen], pos + strlen
+
+    def _coded_keys(self, pos, count):
+        """
+        Yield first `count` titles of front coded block
+        starting at index 2 offset `pos`
+        """
+        pos += self.index2_offset
+        title, pos = self._key(pos)
+        yield title
+        for j in xrange(count - 1):
+            shared = struct.unpack(KEY_LENGTH_FORMAT,
+                                   self.data[pos:pos+self.klen_structsize])[0]
+            suffix, pos = self._key(pos + self.klen_structsize)
+            title = title[:shared] + suffix
+            yield title
+
+    def title(self, i):
+        index2_ptr = self.item(i)[0]
+        if self.front_coding_block:
+            for title in self._coded_keys(index2_ptr,
+                                          i % self.front_coding_block + 1):
+                pass
+            return title
+        return self._key(self.index2_offset + index2_ptr)[0]
+
+    def titles(self):
+        """
+        Yield utf8 encoded titles in index order
+        """
+        if self.front_coding_block:
+            block = self.front_coding_block
+            for start in xrange(0, self.index_count, block):
+                count = min(block, self.index_count - start)
+                for title in self._coded_keys(self.item(start)[0], count):
+                    yield title
+        else:
+            for i in xrange(self.index_count):
+                yield self.title(i)
+
+    def units(self):
+        """
+        Yield (file offset, length) of stored articles and blocks
+        in the order they follow in the file, length includes
+        article length prefix
+        """
+        sections = self.metadata.get('sections')
+        if sections:
+            end = self.article_offset + min(offset for offset, _length
+                                            in sections.itervalues())
+        else:
+            end = len(self.data)
+        pos = self.article_offset
+        while pos < end:
+            length = struct.unpack(
+                ARTICLE_LENGTH_FORMAT,
+                self.data[pos:pos+self.alen_structsize])[0]
+            yield pos, self.alen_structsize + length
+            pos += self.alen_structsize + length
+
+    def stored(self, article_ptr):
+        """
+        Return article or block as it is stored at given
+        article pointer
+        """
+        start = self.article_offset + article_ptr
+        length = struct.unpack(
+            ARTICLE_LENGTH_FORMAT,
+            self.data[start:start+self.alen_structsize])[0]
+        start += self.alen_structsize
+        return self.data[start:start+length]
+
+    def article(self, i):
+        """
+        Return uncompressed serialized article of i-th index item
+        """
+        _index2_ptr, article_ptr, block_offset = self.item(i)
+        if block_offset == NO_BLOCK:
+            return decompress(self.stored(article_ptr), self.preset_prefix)
+        ptr, block = self.block
+        if ptr != article_ptr:
+            block = decompress(self.stored(article_ptr), self.preset_prefix)
+            self.block = (article_ptr, block)
+        length = struct.unpack(
+            ARTICLE_LENGTH_FORMAT,
+            block[block_offset:block_offset+self.alen_structsize])[0]
+        start = block_offset + self.alen_structsize
+        return block[start:start+length]
+
+    def stored_article(self, i, title, isredirect=False, **kwargs):
+        """
+        Return i-th index item as PreparedArticle with compressed
+        article as stored if it can be copied to another volume,
+        otherwise as Article with uncompressed text. Articles in
+        blocks, articles compressed with preset dictionary of this
+        volume and redirects are uncompressed.
+
+        """
+        _index2_ptr, article_ptr, block_offset = self.item(i)
+        if block_offset == NO_BLOCK and not isredirect:
+            stored = self.stored(article_ptr)
+            if stored and not stored.startswith(PRESET_DICTIONARY_MARKER):
+                return PreparedArticle(title, stored, **kwargs)
+        return Article(title, self.article(i), isredirect=isredirect,
+                       **kwargs)
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+
+MANIFEST_VOLUME_NUMBER_RE = re.compile(r'\.\d+_of_\d+$')
+
+def manifest_file_name(file_name):
+    """
+    Return name of build manifest written alongside volumes
+    of a dictionary, given output file name or name of a volume.
+
+    >>> manifest_file_name('enwiki-20130102.aar')
+    'enwiki-20130102.manifest'
+    >>> manifest_file_name('enwiki-20130102.2_of_5.aar')
+    'enwiki-20130102.manifest'
+    >>> manifest_file_name('dict')
+    'dict.manifest'
+
+    """
+    if file_name.endswith('.aar'):
+        file_name = file_name[:-len('.aar')]
+    return MANIFEST_VOLUME_NUMBER_RE.sub('', file_name) + '.manifest'
+
+
+#manifest entry kinds
+MANIFEST_ARTICLE = 'a'
+MANIFEST_REDIRECT = 'r'
+#generated from the same input as preceding entry
+MANIFEST_DERIVED = 'd'
+MANIFEST_LOCATION_FORMAT = '>HL'
+
+
+def reuse_digest(title, digest):
+    return hashlib.sha1(title + '\t' + digest).digest()[:DIGEST_LENGTH]
+
+
+class ReuseDigests(object):
+    """
+    Sorted array of digests of title and source digest of articles
+    that can be taken from previous build, packed in one string.
+    Article source worker processes look up unchanged inputs here
+    instead of in manifest dictionaries of PreviousBuild.
+
+    >>> digests = ReuseDigests([reuse_digest('b', 'x'),
+    ...                         reuse_digest('a', 'y')])
+    >>> len(digests)
+    2
+    >>> digests.unchanged('a', 'y'), digests.unchanged(u'b', 'x')
+    (True, True)
+    >>> digests.unchanged('a', 'x'), digests.unchanged('c', 'y')
+    (False, False)
+
+    """
+
+    def __init__(self, digests):
+        self.data = ''.join(sorted(digests))
+
+    def __len__(self):
+        return len(self.data) // DIGEST_LENGTH
+
+    def __getitem__(self, i):
+        return self.data[i*DIGEST_LENGTH:(i+1)*DIGEST_LENGTH]
+
+    def unchanged(self, title, digest):
+        if isinstance(title, unicode):
+            title = title.encode('utf8')
+        key = reuse_digest(title, digest)
+        i = bisect.bisect_left(self, key)
+        return i < len(self) and self[i] == key
+
+
+class PreviousBuild(object):
+    """
+    Volumes of previous build of a dictionary and its manifest.
+    Manifest is a text file with a line per entry: hex source
+    digest, entry kind and title separated by tabs. Article sources
+    use it to skip converting inputs that didn't change and take
+    their articles from previous volumes instead.
+
+    """
+
+    def __init__(self, volume_file_names, manifest_file_name_):
+        self.reused = 0
+        #title -> source digest followed by volume number
+        #and index item in the volume
+        self.entries = {}
+        self.kinds = {}
+        #title -> titles derived from the same input
+        self.derived = {}
+        #derived titles also generated from another input, only
+        #one of their entries can be located in previous volumes
+        ambiguous = set()
+        with open(manifest_file_name_) as f:
+            parent = None
+            for line in f:
+                digest, kind, title = line.rstrip('\n').split('\t', 2)
+                if title in self.entries and MANIFEST_DERIVED in (
+                        kind, self.kinds.get(title)):
+                    ambiguous.add(title)
+                self.entries[title] = digest.decode('hex')
+                if kind == MANIFEST_DERIVED and parent:
+                    self.derived.setdefault(parent, []).append(title)
+                else:
+                    parent = title
+                if kind != MANIFEST_ARTICLE:
+                    self.kinds[title] = kind
+        log.info('Read %d entries from manifest %s',
+                 len(self.entries), manifest_file_name_)
+        self.volumes = [VolumeReader(name) for name in volume_file_names]
+        for n, volume in enumerate(self.volumes):
+            if Resources.name in volume.metadata.get('sections', {}):
+                #articles refer to resources of their volume
+                log.warn('Not reusing articles of %s, it has resources',
+                         volume.file_name)
+                continue
+            for i, title in enumerate(volume.titles()):
+                entry = self.entries.get(title)
+                if entry is not None and len(entry) == DIGEST_LENGTH:
+                    self.entries[title] = entry + struct.pack(
+                        MANIFEST_LOCATION_FORMAT, n, i)
+        self.reuse_digests = ReuseDigests(
+            reuse_digest(title, entry[:DIGEST_LENGTH])
+            for title, entry in self.entries.iteritems()
+            if self._reusable(title, ambiguous))
+
+    def _reusable(self, title, ambiguous):
+        return (len(self.entries[title]) > DIGEST_LENGTH and
+                self.kinds.get(title) != MANIFEST_DERIVED and
+                title not in ambiguous and
+                all(len(self.entries[derived]) > DIGEST_LENGTH and
+                    derived not in ambiguous
+                    for derived in self.derived.get(title, ())))
+
+    def unchanged(self, title, digest):
+        """
+        Tell whether article with given title was built from input
+        with given source digest and can be taken from previous volumes
+        """
+        return self.reuse_digests.unchanged(title, digest)
+
+    def articles(self, title):
+        """
+        Return articles previously built from the same input as
+        article with given title, starting with the article itself.
+        Compressed articles are passed on as is unless they need
+        preset dictionary of previous volume, articles in blocks
+        and redirects are uncompressed.
+
+        """
+        if isinstance(title, unicode):
+            title = title.encode('utf8')
+        articles = []
+        for t in [title] + self.derived.get(title, []):
+            entry = self.entries[t]
+            digest = entry[:DIGEST_LENGTH]
+            n, i = struct.unpack(MANIFEST_LOCATION_FORMAT,
+                                 entry[DIGEST_LENGTH:])
+            volume = self.volumes[n]
+            kind = self.kinds.get(t, MANIFEST_ARTICLE)
+            articles.append(volume.stored_article(
+                i, t, isredirect=kind != MANIFEST_ARTICLE,
+                counted=kind != MANIFEST_DERIVED, source_digest=digest))
+        self.reused += 1
+        return articles
+
+    def close(self):
+        for volume in self.volumes:
+            volume.close()
+
+
+import threading
+article_add_lock = threading.RLock()
+
+from multiprocessing.pool import ThreadPool
+
+
+class _Done(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+PendingArticle = collections.namedtuple(
+    'PendingArticle',
+    'title redirect count text_len sort_key digest hot resources')
+
+#length of payload digest prefix used to find duplicate payloads
+DIGEST_LENGTH = 12
+#digests of compressed payloads supplied by article source
+#are taken with this prefix so that they never match digests
+#of uncompressed text
+PREPARED_DIGEST_PREFIX = '\0'
+
+def payload_digest(payload, prefix=''):
+    return hashlib.sha1(prefix + payload).digest()[:DIGEST_LENGTH]
+
+#digest, article pointer and in-block offset
+PAYLOAD_SLOT_FORMAT = '>%dsQL' % DIGEST_LENGTH
+#number of consecutive slots a digest may be stored in,
+#when all are taken the first one is overwritten
+PAYLOAD_PROBES = 8
+
+class PayloadTable(object):
+    """
+    Fixed size open addressing hash table of payload digests
+    and their (article pointer, in-block offset) locations, kept
+    in one byte array. Slots are never freed, digests that don't
+    find a free slot replace older ones.
+
+    >>> table = PayloadTable(4)
+    >>> table.add(payload_digest('a'), (10, NO_BLOCK))
+    >>> table.get(payload_digest('a'))
+    (10, 4294967295)
+    >>> table.get(payload_digest('b')) is None
+    True
+
+    """
+
+    slot_len = struct.calcsize(PAYLOAD_SLOT_FORMAT)
+    empty = '\0'*DIGEST_LENGTH
+
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.slots = bytearray(self.size*self.slot_len)
+
+    def _positions(self, digest):
+        start = struct.unpack_from('>Q', digest)[0]
+        for i in xrange(min(PAYLOAD_PROBES, self.size)):
+            yield ((start + i) % self.size)*self.slot_len
+
+    def get(self, digest):
+        for pos in self._positions(digest):
+            slot_digest, article_ptr, block_offset = struct.unpack_from(
+                PAYLOAD_SLOT_FORMAT, self.slots, pos)
+            if slot_digest == digest:
+                return article_ptr, block_offset
+            if slot_digest == self.empty:
+                return None
+        return None
+
+    def add(self, digest, location):
+        positions = list(self._positions(digest))
+        target = positions[0]
+        for pos in positions:
+            slot_digest = self.slots[pos:pos+DIGEST_LENGTH]
+            if slot_digest == digest or slot_digest == self.empty:
+                target = pos
+                break
+        struct.pack_into(PAYLOAD_SLOT_FORMAT, self.slots, target,
+                         digest, *location)
+
+def source_digest(title, text):
+    """
+    Return digest of input article with given title was converted
+    from, title is included so that identical inputs of different
+    articles, such as redirects to the same article, differ
+    """
+    if isinstance(title, unicode):
+        title = title.encode('utf8')
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return payload_digest(title + '\0' + text)
+
+
+class CompressionPipeline(object):
+    """
+    Compresses article payloads on a bounded pool of threads
+    (zlib and bz2 release the GIL) and hands results back
+    in submission order. Threads are started when the first
+    item is submitted, after article source had a chance
+    to fork its worker processes.
+
+    """
+
+    def __init__(self, threads, window=None):
+        self.threads = threads
+        self.pool = None
+        self.window = window if window else 4*threads
+        self.pending = collections.deque()
+
+    def submit(self, item, func, args):
+        if self.pool is None:
+            log.info('Compressing with %d threads, window %d',
+                     self.threads, self.window)
+            self.pool = ThreadPool(self.threads)
+        result = self.pool.apply_async(func, args)
+        self.pending.append((item, result))
+
+    def put(self, item, result):
+        """
+        Queue item that needs no compression behind submitted items
+        """
+        self.pending.append((item, _Done(result)))
+
+    def ready(self):
+        """
+        Yield (item, result) for submitted items that are
+        done, in submission order. Blocks while there are more
+        items pending than pipeline window allows.
+
+        """
+        while self.pending and (len(self.pending) > self.window or
+                                self.pending[0][1].ready()):
+            item, result = self.pending.popleft()
+            yield item, result.get()
+
+    def drain(self):
+        while self.pending:
+            item, result = self.pending.popleft()
+            yield item, result.get()
+
+    @property
+    def running(self):
+        return self.pool is not None
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def top_page_views(lines, count):
+    """
+    Read page view counts from lines of title followed by
+    whitespace and number of views, return dictionary of
+    `count` most viewed titles to their views and
+    total number of views.
+
+    >>> lines = ['A 3', 'B b\t10', 'C 1', 'bad', 'D x']
+    >>> views, total = top_page_views(lines, 2)
+    >>> sorted(views.items()), total
+    ([('A', 3), ('B b', 10)], 14)
+
+    """
+    total = [0]
+    def parse():
+        for line in lines:
+            try:
+                title, hits = line.rstrip('\r\n').rsplit(None, 1)
+                hits = int(hits)
+            except ValueError:
+                continue
+            total[0] += hits
+            yield hits, title
+    top = heapq.nlargest(count, parse())
+    return dict((title, hits) for hits, title in top), total[0]
+
+
+class RedirectResolver(object):
+    """
+    Holds back redirects until all titles are known, then
+    points each redirect directly at the article at the end
+    of its redirect chain.
+
+    >>> r = RedirectResolver()
+    >>> for title, target in ((u'A', u'B'), (u'B', u'C#s'), (u'C', u'c'),
+    ...                       (u'D', u'E'), (u'y', u'y')):
+    ...     assert r.add_redirect(title, tojson(('', [], {u'r': target})))
+    >>> r.add_title(u'c')
+    >>> for title, serialized, counted in sorted(r.resolve()):
+    ...     print title, serialized
+    A ["", [], {"r": "c#s"}]
+    B ["", [], {"r": "c#s"}]
+    C ["", [], {"r": "c"}]
+    D ["", [], {"r": "E"}]
+    y ["", [], {"r": "y"}]
+    >>> r.resolved, r.dangling, r.cyclic
+    (2, [u'D'], [u'y'])
+
+    """
+
+    def __init__(self):
+        self.titles = set()
+        self.redirects = {}
+        self.resolved = 0
+        self.dangling = []
+        self.cyclic = []
+
+    def add_title(self, title):
+        self.titles.add(title)
+
+    def add_redirect(self, title, serialized, counted=True):
+        """
+        Remember redirect, return False if serialized
+        article doesn't look like a redirect
+        """
+        try:
+            text, tags, meta = json.loads(serialized)
+            target = meta[u'r']
+        except (ValueError, TypeError, KeyError):
+            return False
+        self.redirects[title] = (text, tags, meta, counted)
+        return True
+
+    def _follow(self, title):
+        target = self.redirects[title][2][u'r']
+        fragment = None
+        seen = set([title])
+        while True:
+            target_title, sep, target_fragment = target.partition(u'#')
+            if fragment is None and sep:
+                fragment = target_fragment
+            if target_title not in self.redirects:
+                break
+            if target_title in seen:
+                return None, None
+            seen.add(target_title)
+            target = self.redirects[target_title][2][u'r']
+        return target_title, fragment
+
+    def resolve(self):
+        """
+        Yield (title, serialized redirect, counted) for all
+        remembered redirects, rewriting targets of those
+        that point to other redirects.
+
+        """
+        for title, (text, tags, meta, counted) in self.redirects.iteritems():
+            final, fragment = self._follow(title)
+            if final is None:
+                self.cyclic.append(title)
+            elif final not in self.titles:
+                self.dangling.append(title)
+            else:
+                target = final + (u'#' + fragment if fragment else u'')
+                if target != meta[u'r']:
+                    meta[u'r'] = target
+                    self.resolved += 1
+            yield title, tojson((text, tags, meta)), counted
+
 
 class Stats(object):
 
@@ -414,18 +2464,45 @@ class Stats(object):
                                  self.elapsed))
 
 
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+#names of temporary files in session directory start with these
+TEMP_FILE_PREFIXES = ('index1', 'index2', 'articles', 'keys', 'key_offsets',
+                      'sort_keys', 'section_', 'resources', 'reorder_')
+#stats counters recorded at checkpoint
+CHECKPOINT_STATS = ('skipped', 'failed', 'empty', 'articles', 'redirects')
+
 class Compiler(object):
 
     def __init__(self, article_source, output_file_name,
-                 max_file_size_, session_dir, metadata=None):
+                 max_file_size_, session_dir, metadata=None,
+                 compress_threads=0, codec_sample=0, codec_resample=0,
+                 block_size=0, small_article_size=0,
+                 preset_dictionary_sample=0,
+                 sort_processes=1, sort_memory=DEFAULT_SORT_MEMORY,
+                 volume_count=0, index_reserve=0, background_finalize=False,
+                 postprocess_processes=1, dedup_entries=0,
+                 resolve_redirects=False, range_volumes=False,
+                 reorder_articles=False, page_views=None, jump_table=False,
+                 collation_keys=(), bloom_fp=0, front_coded_index=False,
+                 math_resources=False, extent_size=0, checkpoint_interval=0,
+                 resume=False):
         self.uuid = uuid.uuid4()
         self.output_file_name = output_file_name
         self.max_file_size = max_file_size_
         self.index_count = 0
         self.session_dir = session_dir
-        self.failed_articles = open(os.path.join(self.session_dir, "failed.txt"), 'w')
-        self.empty_articles = open(os.path.join(self.session_dir, "empty.txt"), 'w')
-        self.skipped_articles = open(os.path.join(self.session_dir, "skipped.txt"), 'w')
+        self.checkpoint_file_name = os.path.join(session_dir,
+                                                 CHECKPOINT_FILE_NAME)
+        checkpoint = None
+        if resume:
+            with open(self.checkpoint_file_name) as f:
+                checkpoint = json.load(f)
+        self.failed_articles = self.open_log("failed.txt", checkpoint)
+        self.empty_articles = self.open_log("empty.txt", checkpoint)
+        self.skipped_articles = self.open_log("skipped.txt", checkpoint)
+        #source digests of entries, kept if article source supplies them
+        self.manifest = self.open_log("manifest", checkpoint)
+        self.manifest_digest = None
         self.metadata = metadata if metadata is not None else {}
         self.file_names = []
         self.stats = Stats()
@@ -439,74 +2516,553 @@ class Compiler(object):
         #article_count used to mean dictionary total
         #allow readers distinguish between the two
         self.metadata["article_count_is_volume_total"] = True
+        #lets later compilations trust index order of this dictionary
+        self.metadata["icu_version"] = ICU_VERSION
         self.last_stat_update = 0
         self.article_source = article_source
         self.current_volume = None
         self.current_volume_article_count = 0
+        if compress_threads > 1:
+            self.compression = CompressionPipeline(compress_threads)
+        else:
+            self.compression = None
+        self.preset_dictionary_sample = preset_dictionary_sample
+        self.preset_dictionary = None
+        #codecs articles are compressed with, passed to
+        #compression threads with each article
+        self.codecs = BASE_CODECS
+        self.volume_count = volume_count
+        self.index_reserve = index_reserve
+        self.background_finalize = background_finalize
+        #started when first volume is finalized, after
+        #article source forked its worker processes
+        self.finalizer = None
+        #forking sort processes from finalizer thread while other
+        #threads run may leave locks held in child processes,
+        #background finalizer sorts in its own thread
+        self.volume_sort_processes = (1 if background_finalize
+                                      else sort_processes)
+        self.finalizing = None
+        self.postprocess_processes = postprocess_processes
+        self.dedup_entries = dedup_entries
+        self.redirects = RedirectResolver() if resolve_redirects else None
+        #resolved redirects are added after all other articles
+        self.presorted = article_source.presorted and not resolve_redirects
+        self.check_order = not article_source.same_collation
+        self.range_volumes = range_volumes
+        self.reorder_articles = reorder_articles
+        self.jump_table = jump_table
+        self.collation_keys = collation_keys
+        self.bloom_fp = bloom_fp
+        self.front_coded_index = front_coded_index
+        self.math_resources = math_resources
+        self.extent_size = extent_size
+        #most viewed titles go to a dedicated volume
+        #created before any other volume
+        self.hot_volume = None
+        self.hot_volume_article_count = 0
+        self.page_views = {}
+        self.total_hits = self.hot_hits = 0
+        if page_views:
+            self.page_views, self.total_hits = page_views
+        self.staging = None
+        self.first_title = self.last_title = None
+        self.sort_processes = sort_processes
+        self.sort_memory = sort_memory
+        self.block_size = block_size
+        self.small_article_size = small_article_size if block_size else 0
+        if codec_sample > 0:
+            self.codec_selector = CodecSelector(codec_sample, codec_resample)
+        else:
+            self.codec_selector = None
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = 0
+        #temp files of volumes finalized since last checkpoint
+        self.retained_files = []
+        self.resumed_time = 0
+        if checkpoint:
+            self.restore(checkpoint)
+
+    def open_log(self, name, checkpoint=None):
+        file_name = os.path.join(self.session_dir, name)
+        if checkpoint:
+            return reopen(file_name, checkpoint['logs'][name])
+        return open(file_name, 'w')
 
     def run(self):
-        self.stats.start_time = time.time()
-        for article in self.article_source:
+        self.stats.start_time = time.time() - self.resumed_time
+        self.last_checkpoint = time.time()
+        articles = iter(self.article_source)
+        if self.preset_dictionary_sample:
+            articles = self.train_preset_dictionary(articles)
+        if self.page_views:
+            #after training, so that room is left
+            #for preset dictionary in metadata
+            self.hot_volume = self.create_volume()
+        for i, article in enumerate(articles):
             title = article.title
+            if article.source_digest and not (article.failed or
+                                              article.skipped or
+                                              article.empty):
+                self.add_to_manifest(article)
             if article.failed:
                 self.fail_article(title)
             elif article.skipped:
                 self.skip_article(title)
             elif article.empty:
                 self.empty_article(title)
+            elif self.redirects and self.hold_redirect(article):
+                continue
+            elif isinstance(article, PreparedArticle):
+                self.add_prepared_article(title, article.compressed,
+                                          article.sort_key,
+                                          redirect=article.isredirect,
+                                          count=article.counted)
             else:
                 self.add_article(title, article.text,
                                  redirect=article.isredirect, count=article.counted)
+            if self.checkpoint_interval:
+                self.maybe_checkpoint(i + 1)
+        if self.redirects:
+            self.add_resolved_redirects()
+        if self.compression:
+            for item, result in self.compression.drain():
+                self.add_compressed(item, result)
+            self.compression.close()
+        if self.codec_selector:
+            self.codec_selector.report()
+        if self.range_volumes:
+            self.partition_volumes()
         self.finalize_current_volume()
-        self.write_volume_count()
-        self.write_sha1sum()
+        self.finalize_hot_volume()
+        if self.finalizer:
+            self.wait_for_finalizer()
+            self.finalizer.close()
+            self.finalizer.join()
+        self.remove_retained_files()
+        if self.volume_count != Volume.number:
+            if self.volume_count:
+                log.warn('Expected %d volumes, but created %d, '
+                         'rewriting volume count and checksums',
+                         self.volume_count, Volume.number)
+            if self.postprocess_processes > 1 and len(self.file_names) > 1:
+                self.postprocess_volumes()
+            else:
+                self.write_volume_count()
+                self.write_sha1sum()
         rename_files(self.file_names)
+        self.finalize_manifest()
+        if os.path.exists(self.checkpoint_file_name):
+            os.remove(self.checkpoint_file_name)
+
+    def maybe_checkpoint(self, processed):
+        """
+        Take checkpoint if it's due and article source is at
+        a position it can resume from. Articles read ahead to train
+        preset dictionary are not all processed until `processed`
+        reaches sample size.
+
+        """
+        if (processed >= self.preset_dictionary_sample and
+            self.article_source.position is not None and
+            time.time() - self.last_checkpoint >= self.checkpoint_interval):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Add articles being compressed, flush everything
+        added so far to disk and record compilation state
+        so that compilation can be resumed from here.
+
+        """
+        if self.compression:
+            for item, result in self.compression.drain():
+                self.add_compressed(item, result)
+        if self.finalizer:
+            self.wait_for_finalizer()
+        volume_state = None
+        if self.current_volume:
+            self.current_volume.flush_block()
+            volume_state = self.current_volume.checkpoint()
+        logs = {}
+        for f in (self.failed_articles, self.empty_articles,
+                  self.skipped_articles, self.manifest):
+            f.flush()
+            os.fsync(f.fileno())
+            logs[os.path.basename(f.name)] = f.tell()
+        stats = dict((name, getattr(self.stats, name))
+                     for name in CHECKPOINT_STATS)
+        stats['elapsed'] = time.time() - self.stats.start_time
+        state = dict(position=self.article_source.position,
+                     uuid=self.uuid.hex,
+                     volume_number=Volume.number,
+                     file_names=self.file_names,
+                     volume=volume_state,
+                     volume_article_count=self.current_volume_article_count,
+                     logs=logs,
+                     stats=stats,
+                     compress_counts=self.compress_counts_snapshot(),
+                     preset_dictionary=(
+                         base64.b64encode(self.preset_dictionary.data)
+                         if self.preset_dictionary else None))
+        temp_name = self.checkpoint_file_name + '.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_name, self.checkpoint_file_name)
+        log.info('Wrote checkpoint at %s', state['position'])
+        self.remove_retained_files()
+        self.last_checkpoint = time.time()
+
+    def compress_counts_snapshot(self):
+        with compress_counts_lock:
+            return dict(compress_counts)
+
+    def restore(self, checkpoint):
+        """
+        Restore compilation state recorded at checkpoint
+        """
+        self.uuid = uuid.UUID(checkpoint['uuid'])
+        Volume.number = checkpoint['volume_number']
+        self.file_names = checkpoint['file_names']
+        stats = checkpoint['stats']
+        for name in CHECKPOINT_STATS:
+            setattr(self.stats, name, stats[name])
+        self.resumed_time = stats['elapsed']
+        compress_counts.update(checkpoint['compress_counts'])
+        if checkpoint['preset_dictionary']:
+            self.use_preset_dictionary(
+                base64.b64decode(checkpoint['preset_dictionary']))
+        #all of sample articles were processed before checkpoint
+        self.preset_dictionary_sample = 0
+        self.remove_stale_files(checkpoint['volume'])
+        if checkpoint['volume']:
+            self.current_volume = self.create_volume(checkpoint['volume'])
+            self.current_volume_article_count = checkpoint[
+                'volume_article_count']
+        self.article_source.resume(checkpoint['position'])
+        log.info('Resuming at %s', checkpoint['position'])
+
+    def remove_stale_files(self, volume_state):
+        """
+        Remove temporary files and volumes created after checkpoint,
+        they are created again as compilation continues
+        """
+        keep = set()
+        if volume_state:
+            keep.update(volume_state[name] for name in
+                        ('index1', 'index2', 'articles', 'keys'))
+        for name in os.listdir(self.session_dir):
+            file_name = os.path.join(self.session_dir, name)
+            if (name.startswith(TEMP_FILE_PREFIXES) and
+                file_name not in keep):
+                log.info('Removing stale temp file %s', file_name)
+                os.remove(file_name)
+        number = Volume.number + 1
+        while os.path.exists('%s.%d' % (self.output_file_name, number)):
+            file_name = '%s.%d' % (self.output_file_name, number)
+            log.info('Removing stale volume %s', file_name)
+            os.remove(file_name)
+            number += 1
+
+    def remove_retained_files(self):
+        for name in self.retained_files:
+            log.info('Removing temp file %s', name)
+            os.remove(name)
+        del self.retained_files[:]
+
+    def hold_redirect(self, article):
+        """
+        Remember article title or, if article is a redirect,
+        the redirect itself to be added after all titles are known.
+        Return True if article was held back.
+
+        """
+        title = article.title
+        if isinstance(title, str):
+            title = title.decode('utf8')
+        if (article.isredirect and
+            not isinstance(article, PreparedArticle) and
+            self.redirects.add_redirect(title, article.text, article.counted)):
+            return True
+        self.redirects.add_title(title)
+        return False
+
+    def add_resolved_redirects(self):
+        for title, serialized, counted in self.redirects.resolve():
+            self.add_article(title, serialized, redirect=True, count=counted)
+        for name, titles in (('dangling', self.redirects.dangling),
+                             ('cyclic', self.redirects.cyclic)):
+            with open(os.path.join(self.session_dir,
+                                   '%s_redirects.txt' % name), 'w') as f:
+                for title in titles:
+                    f.write(title.encode('utf8')+'\n')
+        log.info('Resolved %d redirect chains, %d redirects are dangling, '
+                 '%d are cyclic', self.redirects.resolved,
+                 len(self.redirects.dangling), len(self.redirects.cyclic))
+
+    def add_to_manifest(self, article):
+        digest = article.source_digest
+        if digest == self.manifest_digest:
+            kind = MANIFEST_DERIVED
+        else:
+            kind = MANIFEST_REDIRECT if article.isredirect else MANIFEST_ARTICLE
+            self.manifest_digest = digest
+        title = article.title
+        if isinstance(title, unicode):
+            title = title.encode('utf8')
+        self.manifest.write('%s\t%s\t%s\n' % (digest.encode('hex'), kind,
+                                              title))
+
+    def finalize_manifest(self):
+        self.manifest.close()
+        if os.path.getsize(self.manifest.name):
+            file_name = manifest_file_name(self.output_file_name)
+            log.info('Renaming %s ==> %s', self.manifest.name, file_name)
+            display.write('Created ').bold(file_name).writeln()
+            os.rename(self.manifest.name, file_name)
+        else:
+            os.remove(self.manifest.name)
+
+    def use_preset_dictionary(self, data):
+        """
+        Compress articles against preset dictionary `data`
+        in addition to base codecs
+        """
+        self.preset_dictionary = PresetDictionary(data)
+        self.codecs = BASE_CODECS + (self.preset_dictionary.codec,)
+        self.metadata['preset_dictionary'] = base64.b64encode(
+            self.preset_dictionary.prefix)
+
+    def train_preset_dictionary(self, articles):
+        """
+        Read sample of articles, train preset dictionary on it and
+        return iterator over all articles, including the sample.
+
+        """
+        sample = list(itertools.islice(articles,
+                                       self.preset_dictionary_sample))
+        texts = [a.text for a in sample
+                 if a.text and not (a.isredirect or a.failed or a.skipped)]
+        texts = [t.encode('utf8') if isinstance(t, unicode) else t
+                 for t in texts]
+        data = train_preset_dictionary(texts)
+        if data:
+            self.use_preset_dictionary(data)
+            log.info('Trained %d byte preset dictionary on %d articles',
+                     len(data), len(texts))
+        else:
+            log.warn('Sample of %d articles is too small '
+                     'to train preset dictionary', len(texts))
+        return itertools.chain(sample, articles)
 
     def finalize_current_volume(self):
         if self.current_volume:
-            self.print_stats(force=True)
-            writeln()
-            m = "Finalizing volume %d" % self.current_volume.number
-            log.info(m)
-            writeln(m).flush()
-            log.info('Collecting metadata...')
-            self.metadata.update(self.article_source.metadata)
-            log.info('Metadata collected')
-            self.metadata['article_count'] = self.current_volume_article_count
-            file_name = self.current_volume.finalize(self.output_file_name,
-                                                     self.serialized_metadata)
-            self.file_names.append(file_name)
-            m = "Wrote volume %d" % self.current_volume.number
-            log.info(m)
-            writeln(m).flush()
+            self.finalize_volume(self.current_volume,
+                                 self.current_volume_article_count)
             self.current_volume = None
             self.current_volume_article_count = 0
 
+    def finalize_hot_volume(self):
+        if self.hot_volume:
+            self.finalize_volume(self.hot_volume,
+                                 self.hot_volume_article_count)
+            self.hot_volume = None
+            self.hot_volume_article_count = 0
+            m = ('Hot volume covers %.1f%% of %d page views' %
+                 (100.0*self.hot_hits/max(self.total_hits, 1),
+                  self.total_hits))
+            log.info(m)
+            writeln(m).flush()
+
+    def finalize_volume(self, volume, article_count):
+        self.print_stats(force=True)
+        writeln()
+        m = "Finalizing volume %d" % volume.number
+        log.info(m)
+        writeln(m).flush()
+        log.info('Collecting metadata...')
+        self.metadata.update(self.article_source.metadata)
+        log.info('Metadata collected')
+        self.metadata['article_count'] = article_count
+        if self.range_volumes:
+            self.metadata['first_title'] = self.first_title
+            self.metadata['last_title'] = self.last_title
+            self.first_title = None
+        args = (self.output_file_name, dict(self.metadata),
+                self.volume_count)
+        if self.background_finalize:
+            if self.finalizer is None:
+                self.finalizer = ThreadPool(1)
+            #finalize one volume at a time
+            self.wait_for_finalizer()
+            self.finalizing = (volume,
+                               self.finalizer.apply_async(volume.finalize,
+                                                          args))
+        else:
+            if self.compression and self.compression.running:
+                #same as in background finalizer, don't fork
+                #sort processes while compression threads run
+                volume.sort_processes = 1
+            self.volume_finalized(volume, volume.finalize(*args))
+
+    def is_hot(self, title, serialized_redirect=None):
+        """
+        Tell whether article belongs to hot volume: it's one of
+        the most viewed articles or a redirect to one
+        """
+        if not self.hot_volume:
+            return False
+        if title in self.page_views:
+            return True
+        if serialized_redirect:
+            try:
+                target = json.loads(serialized_redirect)[2][u'r']
+            except (ValueError, TypeError, KeyError, IndexError):
+                return False
+            return target.partition(u'#')[0].encode('utf8') in self.page_views
+        return False
+
+    def wait_for_finalizer(self):
+        if self.finalizing:
+            volume, result = self.finalizing
+            self.finalizing = None
+            self.volume_finalized(volume, result.get())
+
+    def volume_finalized(self, volume, file_name):
+        #hot volume is the first one, but is finalized last,
+        #file names are kept in volume order
+        numbers = [volume_file_number(name) for name in self.file_names]
+        self.file_names.insert(bisect.bisect(numbers, volume.number),
+                               file_name)
+        if volume.sha1sum:
+            msg = "%s sha1: %s" % (file_name, volume.sha1sum)
+            log.info(msg)
+            writeln(msg)
+        m = "Wrote volume %d" % volume.number
+        log.info(m)
+        writeln(m).flush()
+
     @utf8
     def add_article(self, title, serialized_article, redirect=False, count=True):
+        if not title:
+            log.warn('Blank title, ignoring article "%s"',
+                     serialized_article)
+            return
+        if not serialized_article:
+            self.empty_article(title)
+            return
+        resources = ()
+        if self.math_resources and not redirect:
+            serialized_article, resources = extract_resources(
+                serialized_article)
+        digest = None
+        if self.dedup_entries:
+            digest = payload_digest(serialized_article)
+        hot = self.is_hot(title, serialized_article if redirect else None)
+        item = PendingArticle(title, redirect, count,
+                              len(serialized_article), None, digest, hot,
+                              resources)
+        volume = self.hot_volume if hot else self.current_volume
+        if digest and volume and volume.payload_location(digest):
+            self.add_uncompressed(item, (SHARED, serialized_article, None))
+            return
+        if len(serialized_article) <= self.small_article_size:
+            self.add_uncompressed(item, (BLOCK, serialized_article, None))
+            return
+        if self.codec_selector:
+            codecs, measure = self.codec_selector.select(
+                redirect, len(serialized_article), self.codecs)
+        else:
+            codecs, measure = self.codecs, False
+        args = (serialized_article, codecs, measure)
+        if self.compression:
+            self.compression.submit(item, run_codecs, args)
+            for item, result in self.compression.ready():
+                self.add_compressed(item, result)
+        else:
+            self.add_compressed(item, run_codecs(*args))
+
+    @utf8
+    def add_prepared_article(self, title, compressed, sort_key,
+                             redirect=False, count=True):
+        digest = None
+        if self.dedup_entries:
+            digest = payload_digest(compressed, PREPARED_DIGEST_PREFIX)
+        item = PendingArticle(title, redirect, count, None, sort_key, digest,
+                              self.is_hot(title), ())
+        self.add_uncompressed(item, (PREPARED, compressed, None))
+
+    def add_uncompressed(self, item, result):
+        """
+        Add item that needs no compression
+        after items already being compressed
+        """
+        if self.compression:
+            self.compression.put(item, result)
+        else:
+            self.add_compressed(item, result)
+
+    def add_compressed(self, item, result):
+        codec, compressed, measurements = result
         with article_add_lock:
 
-            if self.current_volume is None:
-                self.current_volume = self.create_volume()
+            if item.hot and self.hot_volume:
+                volume = self.hot_volume
+            else:
+                if self.current_volume is None:
+                    self.current_volume = self.create_volume()
+                volume = self.current_volume
+
+            location = None
+            if item.digest:
+                location = volume.payload_location(item.digest)
+            if codec == SHARED and not location:
+                #volume changed since duplicate was found
+                if len(compressed) <= self.small_article_size:
+                    result = BLOCK, compressed, None
+                else:
+                    result = run_codecs(compressed, self.codecs)
+                codec, compressed, measurements = result
 
-            if not title:
-                log.warn('Blank title, ignoring article "%s"',
-                         serialized_article)
-                return
-            if not serialized_article:
-                self.empty_article(title)
-                return
-            log.debug('Adding article for "%s"', title)
+            if self.range_volumes:
+                volume.counted = item.count and not item.redirect
+            log.debug('Adding article for "%s"', item.title)
             try:
-                self.current_volume.add(title, compress(serialized_article))
+                if item.resources:
+                    volume.add_resources(item.resources)
+                if location:
+                    volume.add_ref(item.title, location,
+                                   sort_key=item.sort_key)
+                elif codec == BLOCK:
+                    volume.add_to_block(item.title, compressed,
+                                        digest=item.digest)
+                else:
+                    volume.add(item.title, compressed,
+                               sort_key=item.sort_key,
+                               digest=item.digest)
             except Volume.ExceedsMaxSize:
-                self.finalize_current_volume()
-                self.add_article(title, serialized_article, redirect=redirect, count=count)
+                if volume is self.hot_volume:
+                    self.finalize_hot_volume()
+                else:
+                    self.finalize_current_volume()
+                self.add_compressed(item, result)
                 return
-            if count:
-                if not redirect:
+            count_compressed(SHARED if location else codec)
+            if (self.codec_selector and not location and
+                codec not in (BLOCK, PREPARED)):
+                self.codec_selector.record(item.redirect, item.text_len, codec,
+                                           measurements)
+            if volume is self.hot_volume:
+                self.hot_hits += self.page_views.get(item.title, 0)
+            if item.count:
+                if not item.redirect:
                     self.stats.articles += 1
-                    self.current_volume_article_count += 1
+                    if volume is self.hot_volume:
+                        self.hot_volume_article_count += 1
+                    else:
+                        self.current_volume_article_count += 1
                 else:
                     self.stats.redirects += 1
             self.print_stats()
@@ -535,16 +3091,99 @@ class Compiler(object):
             self.last_stat_update = t
             print_progress(self.stats)
 
-    def create_volume(self):
+    def partition_volumes(self):
+        """
+        Sort all staged articles and add them to volumes
+        in collation order, so that each volume covers
+        a contiguous range of titles.
+
+        """
+        self.staging = self.current_volume
+        self.current_volume = None
+        self.current_volume_article_count = 0
+        if self.staging is None:
+            return
+        m = 'Partitioning %d items into volumes' % self.staging.index_count
+        log.info(m)
+        writeln(m).flush()
+        for title, counted, location, payload in self.staging.sorted_items():
+            self.add_sorted(title, counted, location, payload)
+
+    def add_sorted(self, title, counted, location, payload):
+        if self.current_volume is None:
+            self.current_volume = self.create_volume()
+        volume = self.current_volume
+        if location in self.staging.shared:
+            key = payload_digest(struct.pack('>QL', *location))
+            shared_location = volume.payload_location(key)
+        else:
+            key = shared_location = None
+        try:
+            if shared_location:
+                volume.add_ref(title, shared_location)
+            elif location[1] == NO_BLOCK:
+                volume.add(title, payload, digest=key)
+            else:
+                volume.add_to_block(title, payload, digest=key)
+        except Volume.ExceedsMaxSize:
+            self.finalize_current_volume()
+            self.add_sorted(title, counted, location, payload)
+            return
+        title = title.decode('utf8')
+        if self.first_title is None:
+            self.first_title = title
+        self.last_title = title
+        if counted:
+            self.current_volume_article_count += 1
+
+    def create_volume(self, state=None):
+        if self.range_volumes and self.staging is None:
+            return StagingVolume(self.uuid,
+                                 self.session_dir,
+                                 block_size=self.block_size,
+                                 sort_processes=self.sort_processes,
+                                 sort_memory=self.sort_memory,
+                                 dedup_entries=self.dedup_entries)
         header_meta_len = spec_len(HEADER_SPEC) + len(self.serialized_metadata)
+        if self.staging:
+            #room for first and last title in metadata,
+            #escaped title may take up to six times as much
+            header_meta_len += 2*(6*self.staging.max_title_len + 32)
         return Volume(self.uuid,
                       header_meta_len,
                       self.max_file_size,
-                      self.session_dir)
+                      self.session_dir,
+                      block_size=self.block_size,
+                      sort_processes=self.volume_sort_processes,
+                      sort_memory=self.sort_memory,
+                      output_file_name=self.output_file_name,
+                      index_reserve=self.index_reserve,
+                      dedup_entries=self.dedup_entries,
+                      presorted=self.presorted or self.staging is not None,
+                      check_order=self.check_order and self.staging is None,
+                      reorder_articles=self.reorder_articles,
+                      sections=self.make_sections(),
+                      front_coded_index=self.front_coded_index,
+                      extent_size=self.extent_size,
+                      state=state,
+                      retain_files=(self.retained_files
+                                    if self.checkpoint_interval else None))
+
+    def make_sections(self):
+        sections = []
+        if self.jump_table:
+            sections.append(JumpTable())
+        if self.collation_keys:
+            sections.append(CollationKeys(self.collation_keys))
+        if self.bloom_fp:
+            sections.append(BloomFilter(self.bloom_fp))
+        if self.math_resources:
+            sections.append(Resources())
+        return sections
 
     @property
     def serialized_metadata(self):
-        return compress(tojson(self.metadata).encode('utf8'))
+        return serialize_metadata(self.metadata)
 
     def write_sha1sum(self):
         for file_name in self.file_names:
@@ -565,6 +3204,44 @@ class Compiler(object):
             output_file.write(sha1sum)
             output_file.close()
 
+    def postprocess_volumes(self):
+        """
+        Write volume count and checksum to all volumes
+        concurrently, one volume per worker process
+        """
+        log.info("Writing volume count %d and checksums to all volumes",
+                 Volume.number)
+        offset = spec_len(HEADER_SPEC[:2])
+        total = float(sum(os.stat(file_name).st_size - offset
+                          for file_name in self.file_names))
+        progress = dict((file_name, 0) for file_name in self.file_names)
+        queue = multiprocessing.Queue()
+        pool = multiprocessing.Pool(min(self.postprocess_processes,
+                                        len(self.file_names)),
+                                    _init_postprocess, (queue,))
+        try:
+            result = pool.map_async(postprocess_volume,
+                                    [(file_name, Volume.number)
+                                     for file_name in self.file_names])
+            msg = "Calculating checksums for %d volumes" % len(self.file_names)
+            log.info(msg)
+            while not result.ready():
+                try:
+                    file_name, pos = queue.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+                progress[file_name] = pos
+                (display.erase_line().cr()
+                .write(msg).write(': ')
+                .write('%.1f%%' % (100*sum(progress.itervalues())/total)))
+            for file_name, sha1sum in result.get():
+                msg = "%s sha1: %s" % (file_name, sha1sum)
+                log.info(msg)
+                display.erase_line().cr().writeln(msg)
+        finally:
+            pool.close()
+            pool.join()
+
     def write_volume_count(self):
         _name, fmt = HEADER_SPEC[5]
         log.info("Writing volume count %d to all volumes as %s",
@@ -577,6 +3254,51 @@ class Compiler(object):
             output_file.close()
 
 
+postprocess_progress = None
+
+def _init_postprocess(queue):
+    global postprocess_progress
+    postprocess_progress = queue
+
+def postprocess_volume((file_name, volume_count)):
+    """
+    Write volume count to volume header, calculate and write its
+    checksum. Runs in worker processes, progress is reported
+    to `postprocess_progress` queue.
+
+    """
+    _name, fmt = HEADER_SPEC[5]
+    with open(file_name, "r+b") as output_file:
+        output_file.seek(spec_len(HEADER_SPEC[:5]))
+        output_file.write(struct.pack(fmt, volume_count))
+    last_reported = time.time()
+    for pos, sha1sum in calcsha1(file_name, spec_len(HEADER_SPEC[:2])):
+        if postprocess_progress and time.time() - last_reported > 0.5:
+            postprocess_progress.put((file_name, pos))
+            last_reported = time.time()
+    sha1sum = sha1sum.hexdigest()
+    with open(file_name, "r+b") as output_file:
+        output_file.seek(spec_len(HEADER_SPEC[:1]))
+        output_file.write(sha1sum)
+    return file_name, sha1sum
+
+
+def serialize_metadata(metadata):
+    #readers need metadata to decompress articles
+    #compressed with preset dictionary
+    return compress(tojson(metadata).encode('utf8'), BASE_CODECS)
+
+def volume_file_number(file_name):
+    """
+    Return number of volume written to file with given
+    name before it is renamed
+
+    >>> volume_file_number('enwiki-20090530-2.aar.12')
+    12
+
+    """
+    return int(file_name.rsplit('.', 1)[1])
+
 def rename_files(file_names):
     """
     >>> from minimock import mock
@@ -637,28 +3359,247 @@ def _zlib(s):
 def _bz2(s):
     return bz2.compress(s)
 
+#first byte of articles compressed against preset dictionary,
+#zlib and bz2 streams, JSON text and uncompressed
+#blocks never start with it
+PRESET_DICTIONARY_MARKER = '\xff'
+
+class PresetDictionary(object):
+    """
+    Deflate compression against a shared dictionary. zlib module
+    doesn't expose deflateSetDictionary, so compressor is primed
+    by compressing dictionary itself and sync flushing. Compressed
+    prefix is stored once in volume metadata, each article is
+    compressed by a copy of primed compressor and stored as
+    marker byte followed by continuation of the prefix stream.
+
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.compressor = zlib.compressobj(9)
+        self.prefix = (self.compressor.compress(data) +
+                       self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def compress(self, text):
+        c = self.compressor.copy()
+        return PRESET_DICTIONARY_MARKER + c.compress(text) + c.flush()
+
+    def decompress(self, compressed):
+        d = zlib.decompressobj()
+        d.decompress(self.prefix)
+        return (d.decompress(compressed[len(PRESET_DICTIONARY_MARKER):]) +
+                d.flush())
+
+    @property
+    def codec(self):
+        """
+        Codec function compressing against this dictionary
+        """
+        def _zdict(s):
+            return self.compress(s)
+        return _zdict
+
+def decompress(data, preset_prefix=None):
+    """
+    Decompress article, block or metadata stored in a volume,
+    data that is not compressed is returned as is.
+    `preset_prefix` is compressed preset dictionary from
+    volume metadata.
+
+    >>> decompress(_zlib('abc')), decompress(_bz2('abc')), decompress('[1]')
+    ('abc', 'abc', '[1]')
+
+    """
+    if preset_prefix and data.startswith(PRESET_DICTIONARY_MARKER):
+        d = zlib.decompressobj()
+        d.decompress(preset_prefix)
+        return (d.decompress(data[len(PRESET_DICTIONARY_MARKER):]) +
+                d.flush())
+    try:
+        return zlib.decompress(data)
+    except zlib.error:
+        pass
+    try:
+        return bz2.decompress(data)
+    except IOError:
+        pass
+    return data
+
+PRESET_TOKEN_RE = re.compile(r'<[^<>]{1,200}>|[^<>\s]{2,40}\s?')
+
+def train_preset_dictionary(texts, size=32*1024):
+    """
+    Build preset dictionary from most common markup and words
+    of given sample texts. Items that save most are placed
+    at the end of the dictionary where matches are cheapest.
+
+    >>> sample = ['<p class="x">one two</p>', '<p class="x">two</p>']
+    >>> train_preset_dictionary(sample)
+    'two</p><p class="x">'
+
+    >>> train_preset_dictionary(sample, size=8)
+    'two</p>'
+
+    """
+    counts = collections.Counter()
+    for text in texts:
+        counts.update(set(PRESET_TOKEN_RE.findall(text)))
+    scored = sorted(((n*len(token), token)
+                     for token, n in counts.iteritems() if n > 1),
+                    reverse=True)
+    selected = []
+    total = 0
+    for _score, token in scored:
+        if total + len(token) > size:
+            continue
+        selected.append(token)
+        total += len(token)
+    return ''.join(reversed(selected))
+
 from collections import defaultdict
 compress_counts = defaultdict(int)
+#background finalizer compresses blocks
+#while articles are being added
+compress_counts_lock = threading.Lock()
+
+def count_compressed(name, count=1):
+    with compress_counts_lock:
+        compress_counts[name] += count
+
+BASE_CODECS = (_zlib, _bz2)
+
+#pseudo codec name for small articles compressed in blocks
+BLOCK = 'block'
+#pseudo codec name for articles compressed by article source
+PREPARED = 'prepared'
+#pseudo codec name for articles sharing payload with another article
+SHARED = 'shared'
+
+def run_codecs(text, codecs=None, measure=False):
+    """
+    Compress text with each of given codecs and return tuple of
+    name of the codec that produced the smallest output
+    ('none' if none is smaller than text itself), compressed text
+    and, if requested, list of (codec name, output size, seconds)
+    measurements. Safe to call from multiple threads.
 
-def compress(text):
+    """
+    if codecs is None:
+        codecs = BASE_CODECS
     compressed = text
     cfunc = None
-    for func in (_zlib, _bz2):
+    measurements = [] if measure else None
+    for func in codecs:
+        t0 = time.time()
         c = func(text)
+        if measure:
+            measurements.append((func.__name__, len(c), time.time() - t0))
         if len(c) < len(compressed):
             compressed = c
             cfunc = func
-    if cfunc:
-        compress_counts[cfunc.__name__] += 1
-    else:
-        compress_counts['none'] += 1
+    return (cfunc.__name__ if cfunc else 'none'), compressed, measurements
+
+def compress(text, codecs=None):
+    codec, compressed, _ = run_codecs(text, codecs)
+    count_compressed(codec)
     return compressed
 
 
+class CodecSelector(object):
+    """
+    Learns from a sample which codec wins for each kind of payload
+    (redirect or article) and size bucket (power of two), then
+    compresses payloads in that bucket with the winning codec only.
+    Every `resample` payloads a bucket is sampled again with all
+    codecs. Estimated CPU time saved and size lost compared
+    to trying all codecs are reported in `compress_counts`.
+
+    """
+
+    class Bucket(object):
+
+        def __init__(self):
+            self.count = 0
+            self.sampled = 0
+            self.sampled_bytes = 0
+            self.best_bytes = 0
+            self.sizes = defaultdict(int)
+            self.seconds = defaultdict(float)
+            self.codec = None
+
+        def choose(self):
+            self.codec = min(self.sizes, key=self.sizes.get)
+
+    def __init__(self, sample_size, resample):
+        self.sample_size = sample_size
+        self.resample = resample
+        self.buckets = defaultdict(CodecSelector.Bucket)
+        self.seconds_saved = 0.0
+        self.bytes_lost = 0.0
+
+    def _bucket(self, redirect, text_len):
+        return self.buckets[(bool(redirect), text_len.bit_length())]
+
+    def select(self, redirect, text_len, codecs):
+        """
+        Return tuple of `codecs` to run for the next payload of this
+        kind and size and whether their performance should be measured.
+
+        """
+        bucket = self._bucket(redirect, text_len)
+        bucket.count += 1
+        if (bucket.codec is None or
+            (self.resample and bucket.count % self.resample == 0)):
+            return codecs, True
+        if bucket.codec == 'none':
+            return (), False
+        return tuple(func for func in codecs
+                     if func.__name__ == bucket.codec), False
+
+    def record(self, redirect, text_len, codec, measurements):
+        bucket = self._bucket(redirect, text_len)
+        if measurements is None:
+            if not bucket.sampled_bytes:
+                return
+            scale = float(text_len) / bucket.sampled_bytes
+            self.seconds_saved += scale * sum(
+                seconds for name, seconds in bucket.seconds.iteritems()
+                if name != bucket.codec)
+            self.bytes_lost += scale * (bucket.sizes[bucket.codec] -
+                                        bucket.best_bytes)
+            return
+        count_compressed('sampled')
+        bucket.sampled += 1
+        bucket.sampled_bytes += text_len
+        bucket.sizes['none'] += text_len
+        best = text_len
+        for name, size, seconds in measurements:
+            bucket.sizes[name] += size
+            bucket.seconds[name] += seconds
+            best = min(best, size)
+        bucket.best_bytes += best
+        if bucket.sampled >= self.sample_size:
+            bucket.choose()
+
+    def report(self):
+        for (redirect, bits), bucket in sorted(self.buckets.iteritems()):
+            log.info('%s up to %d bytes: %d payloads, %d sampled, using %s',
+                     'Redirects' if redirect else 'Articles', 2**bits,
+                     bucket.count, bucket.sampled, bucket.codec)
+        with compress_counts_lock:
+            compress_counts['est. cpu ms saved'] = int(1000*self.seconds_saved)
+            compress_counts['est. bytes lost'] = int(self.bytes_lost)
+
+
 collator = Collator.createInstance(Locale(''))
 collator.setStrength(Collator.QUATERNARY)
 collation_key = collator.getCollationKey
 
+primary_collator = Collator.createInstance(Locale(''))
+primary_collator.setStrength(Collator.PRIMARY)
+primary_collation_key = primary_collator.getCollationKey
+
 
 def make_output_file_name(input_file, options, session_dir):
     """
@@ -954,6 +3895,254 @@ def make_argparser():
         help='Update number for the compiled dictionary. Default: %(default)s'
         )
 
+    parser.add_argument(
+        '--compress-threads',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of threads compressing articles, '
+        '0 or 1 to compress in main thread. Default: %(default)s'
+        )
+
+    parser.add_argument(
+        '--codec-sample',
+        type=int,
+        default=0,
+        help='Number of articles of each kind and size to compress '
+        'with all codecs before settling on the one that compresses best. '
+        'Articles may come out bigger than when all codecs are tried, '
+        'for example 200 is a good value for large dictionaries. '
+        'Default: %(default)s (always try all codecs)'
+        )
+
+    parser.add_argument(
+        '--codec-resample',
+        type=int,
+        default=5000,
+        help='Compress every Nth article of each kind and size with all '
+        'codecs again, 0 to never resample. Only used with --codec-sample. '
+        'Default: %(default)s'
+        )
+
+    parser.add_argument(
+        '--volumes',
+        type=int,
+        default=0,
+        help='Expected number of volumes. If known, volume count is '
+        'written and checksum calculated as volumes are written instead '
+        'of in separate passes at the end. Default: %(default)s (unknown)'
+        )
+
+    parser.add_argument(
+        '--index-reserve',
+        default='0',
+        help='Write articles directly to volume files after this much space '
+        'reserved for header, metadata and index instead of concatenating '
+        'temporary files at the end. Volume is finished when its index '
+        'doesn\'t fit, unused space is left as padding before articles. '
+        'Default: %(default)s (use temporary files)'
+        )
+
+    parser.add_argument(
+        '--background-finalize',
+        action='store_true',
+        help='Sort and write full volumes in background '
+        'while next volume is being filled, volumes are then '
+        'sorted by one process'
+        )
+
+    parser.add_argument(
+        '--postprocess-processes',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of volumes to write volume count and checksum to '
+        'concurrently. Default: %(default)s'
+        )
+
+    parser.add_argument(
+        '--jump-table',
+        action='store_true',
+        help='Add table of index ranges for title prefixes '
+        'to each volume to speed up lookups'
+        )
+
+    parser.add_argument(
+        '--collation-keys',
+        default='',
+        help='Comma separated list of collation strengths (%s) '
+        'to store ICU sort keys of all titles at, so that readers '
+        'can search by comparing bytes' % ', '.join(sorted(COLLATION_STRENGTHS))
+        )
+
+    parser.add_argument(
+        '--previous',
+        nargs='+',
+        metavar='VOLUME',
+        help='Volumes of previous build of the same dictionary. '
+        'Articles whose input didn\'t change since, according to '
+        'manifest written alongside previous build, are copied from '
+        'these volumes instead of being converted and compressed again. '
+        'Changes in templates and other articles an article '
+        'depends on are not detected. Not all article sources support it'
+        )
+
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=int,
+        default=0,
+        help='Record compilation state in session directory about every '
+        'this many seconds so that interrupted compilation can be '
+        'continued with --resume. Not all article sources support it, '
+        'can\'t be used with --resolve-redirects, --range-volumes, '
+        '--page-views or --math-resources. '
+        'Default: %(default)s (no checkpoints)'
+        )
+
+    parser.add_argument(
+        '--resume',
+        metavar='SESSION_DIR',
+        help='Continue compilation interrupted after a checkpoint '
+        'was recorded in this session directory, other arguments '
+        'must be the same as in interrupted compilation'
+        )
+
+    parser.add_argument(
+        '--extent-checksums',
+        default='0',
+        help='Add CRC32 checksums of each extent of this size '
+        '(for example 1M) to volumes so that parts of volume files '
+        'can be verified independently. '
+        'Default: %(default)s (no extent checksums)'
+        )
+
+    parser.add_argument(
+        '--math-resources',
+        action='store_true',
+        help='Store math images inlined in articles as data URIs '
+        'once per volume in resources section and replace '
+        'them with references. Can\'t be used with --range-volumes '
+        'or --prepare-in-workers'
+        )
+
+    parser.add_argument(
+        '--front-coded-index',
+        action='store_true',
+        help='Store titles in index sharing prefixes with preceding '
+        'titles (format version 3, not supported by older readers)'
+        )
+
+    parser.add_argument(
+        '--bloom-fp',
+        type=float,
+        default=0,
+        help='Add Bloom filter of titles with this false positive rate '
+        '(for example 0.01) to each volume so that readers can quickly '
+        'reject keys that are not in the volume. '
+        'Default: %(default)s (no Bloom filter)'
+        )
+
+    parser.add_argument(
+        '--page-views',
+        help='Name of a file with page view counts, one title '
+        'followed by whitespace and number of views per line. '
+        'Most viewed articles and redirects to them are put in '
+        'a separate first volume so that they are stored close together'
+        )
+
+    parser.add_argument(
+        '--hot-count',
+        type=int,
+        default=10000,
+        help='Number of most viewed titles to put in the first volume '
+        'when --page-views is specified. Default: %(default)s'
+        )
+
+    parser.add_argument(
+        '--reorder-articles',
+        action='store_true',
+        help='Rewrite articles of each volume in title order when '
+        'volume is finalized, so that articles with adjacent titles '
+        'are stored close to each other. Can\'t be used with '
+        '--index-reserve'
+        )
+
+    parser.add_argument(
+        '--range-volumes',
+        action='store_true',
+        help='Sort all articles before splitting them into volumes so '
+        'that each volume covers a contiguous range of titles, '
+        'first and last title of each volume are recorded in its metadata. '
+        'Requires temporary disk space for the whole dictionary'
+        )
+
+    parser.add_argument(
+        '--resolve-redirects',
+        action='store_true',
+        help='Point redirects directly at the article at the end '
+        'of redirect chain. Redirects are kept in memory until all '
+        'articles are compiled, dangling and cyclic redirects '
+        'are listed in session directory'
+        )
+
+    parser.add_argument(
+        '--dedup-entries',
+        type=int,
+        default=0,
+        help='Store identical articles once per volume, remembering '
+        'up to this many distinct article digests per volume '
+        '(24 to 48 bytes of memory each). '
+        'Default: %(default)s (no deduplication)'
+        )
+
+    parser.add_argument(
+        '--prepare-in-workers',
+        action='store_true',
+        help='Article sources that support it compress articles and '
+        'compute sort keys in their worker processes'
+        )
+
+    parser.add_argument(
+        '--sort-processes',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of processes sorting volume index. '
+        'Default: %(default)s'
+        )
+
+    parser.add_argument(
+        '--sort-memory',
+        default='512M',
+        help='Approximate memory budget for sorting volume index, '
+        'index is sorted in runs that fit in it and merged. '
+        'Default: %(default)s'
+        )
+
+    parser.add_argument(
+        '--preset-dictionary-sample',
+        type=int,
+        default=0,
+        help='Train preset compression dictionary on this many first '
+        'articles and compress articles against it when that is smaller '
+        '(creates format version 4 volumes, not supported by older readers). '
+        'Default: %(default)s (no preset dictionary)'
+        )
+
+    parser.add_argument(
+        '--block-size',
+        default='0',
+        help='Pack runs of consecutive small articles into compressed blocks '
+        'of about this size (creates format version 2 volumes, '
+        'readers must support article blocks). '
+        'Default: %(default)s (no blocks)'
+        )
+
+    parser.add_argument(
+        '--small-article-size',
+        type=int,
+        default=256,
+        help='Articles of at most this many bytes go into blocks '
+        'if --block-size is set. Default: %(default)s'
+        )
+
 
     return parser
 
@@ -996,12 +4185,22 @@ def main():
     #TODO replace all regs to "options" with args
     options = args
 
-    session_dir = os.path.join(options.work_dir,
-                               'aardc-'+
-                               os.path.basename(input_files[0]).replace(' ', '-') +
-                               ('-%s' % int(time.time())).replace('.','-'))
-
-    if os.path.exists(session_dir):
+    if options.resume:
+        session_dir = options.resume
+    else:
+        session_dir = os.path.join(options.work_dir,
+                                   'aardc-'+
+                                   os.path.basename(input_files[0]).replace(' ', '-') +
+                                   ('-%s' % int(time.time())).replace('.','-'))
+
+    if options.resume:
+        if not os.path.exists(os.path.join(session_dir,
+                                           CHECKPOINT_FILE_NAME)):
+            sys.stderr.write('No checkpoint found in session directory %s, '
+                             'can\'t resume\n' % session_dir)
+            raise SystemExit(1)
+        display.write('Resuming in session dir ').bold(session_dir).writeln()
+    elif os.path.exists(session_dir):
         sys.stderr.write('Session directory %s already'
                          ' exists, can\'t proceed\n' % session_dir)
         raise SystemExit(1)
@@ -1045,6 +4244,58 @@ def main():
                  'setting index item format to %s',
                  INDEX1_ITEM_FORMAT)
 
+    if parse_size(options.index_reserve) >= max_volume_size:
+        sys.stderr.write('Index reserve must be smaller '
+                         'than maximum file size\n')
+        raise SystemExit(1)
+
+    if options.reorder_articles and parse_size(options.index_reserve):
+        sys.stderr.write('--reorder-articles can\'t be used '
+                         'with --index-reserve\n')
+        raise SystemExit(1)
+
+    collation_keys = [strength.strip().lower() for strength
+                      in options.collation_keys.split(',') if strength.strip()]
+    for strength in collation_keys:
+        if strength not in COLLATION_STRENGTHS:
+            sys.stderr.write('Unknown collation strength %s\n' % strength)
+            raise SystemExit(1)
+
+    if options.math_resources and (options.range_volumes or
+                                   options.prepare_in_workers):
+        sys.stderr.write('--math-resources can\'t be used with '
+                         '--range-volumes or --prepare-in-workers\n')
+        raise SystemExit(1)
+
+    if not 0 <= options.bloom_fp < 1:
+        sys.stderr.write('Bloom filter false positive rate '
+                         'must be between 0 and 1\n')
+        raise SystemExit(1)
+
+    if options.previous and options.math_resources:
+        sys.stderr.write('--previous can\'t be used '
+                         'with --math-resources\n')
+        raise SystemExit(1)
+
+    if (options.checkpoint_interval or options.resume) and (
+            options.resolve_redirects or options.range_volumes or
+            options.page_views or options.math_resources):
+        sys.stderr.write('Checkpoints can\'t be used with '
+                         '--resolve-redirects, --range-volumes, '
+                         '--page-views or --math-resources\n')
+        raise SystemExit(1)
+
+    page_views = None
+    if options.page_views:
+        if options.range_volumes:
+            sys.stderr.write('--page-views can\'t be used '
+                             'with --range-volumes\n')
+            raise SystemExit(1)
+        with open(options.page_views) as f:
+            page_views = top_page_views(f, options.hot_count)
+        log.info('Read page views of %d most viewed titles',
+                 len(page_views[0]))
+
     if not options.dict_ver:
         options.dict_ver = guess_version(input_files[0])
         if options.dict_ver:
@@ -1069,10 +4320,60 @@ def main():
 
     article_source = args.article_source_class(args)
 
+    if ((options.checkpoint_interval or options.resume) and
+        not article_source.resumable):
+        sys.stderr.write('%s article source can\'t resume '
+                         'from checkpoints\n' % article_source.name())
+        raise SystemExit(1)
+
+    previous = None
+    if options.previous:
+        if not article_source.reuses_previous:
+            sys.stderr.write('%s article source can\'t reuse articles '
+                             'of previous build\n' % article_source.name())
+            raise SystemExit(1)
+        previous_manifest = manifest_file_name(options.previous[0])
+        if not os.path.exists(previous_manifest):
+            sys.stderr.write('Manifest %s of previous build '
+                             'not found\n' % previous_manifest)
+            raise SystemExit(1)
+        writeln('Reading previous build...')
+        previous = PreviousBuild(options.previous, previous_manifest)
+        article_source.previous = previous
+
     display.write('Converting ').bold(', '.join(input_files)).writeln()
 
-    compiler = Compiler(article_source, output_file_name, max_volume_size,
-                        session_dir, metadata)
+    try:
+        compiler = Compiler(article_source, output_file_name, max_volume_size,
+                            session_dir, metadata,
+                            compress_threads=options.compress_threads,
+                            codec_sample=options.codec_sample,
+                            codec_resample=options.codec_resample,
+                            block_size=parse_size(options.block_size),
+                            small_article_size=options.small_article_size,
+                            preset_dictionary_sample=options.preset_dictionary_sample,
+                            sort_processes=options.sort_processes,
+                            sort_memory=parse_size(options.sort_memory),
+                            volume_count=options.volumes,
+                            index_reserve=parse_size(options.index_reserve),
+                            background_finalize=options.background_finalize,
+                            postprocess_processes=options.postprocess_processes,
+                            dedup_entries=options.dedup_entries,
+                            resolve_redirects=options.resolve_redirects,
+                            range_volumes=options.range_volumes,
+                            reorder_articles=options.reorder_articles,
+                            page_views=page_views,
+                            jump_table=options.jump_table,
+                            collation_keys=collation_keys,
+                            bloom_fp=options.bloom_fp,
+                            front_coded_index=options.front_coded_index,
+                            math_resources=options.math_resources,
+                            extent_size=parse_size(options.extent_checksums),
+                            checkpoint_interval=options.checkpoint_interval,
+                            resume=bool(options.resume))
+    except ResumeError, e:
+        sys.stderr.write('Can\'t resume: %s\n' % e)
+        raise SystemExit(1)
 
     display.erase_line().writeln('total: %d' % compiler.stats.total)
 
@@ -1081,6 +4382,10 @@ def main():
 
     compiler.run()
 
+    if previous:
+        log.info('Reused %d articles of previous build', previous.reused)
+        previous.close()
+
     log.info(compiler.stats)
     log.info('Compression: %s',
              ', '.join('%s - %d' % item
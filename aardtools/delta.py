@@ -0,0 +1,394 @@
+#!/usr/bin/python
+
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2013  Igor Tkach
+
+"""
+Binary patches between two versions of a compiled dictionary.
+
+A patch describes each new volume as a sequence of byte ranges
+copied from old volumes and literal data. Stored articles and blocks
+of new volumes are looked up in old volumes by hash of their stored
+bytes, everything else (header, metadata, indexes, sections) and
+articles that are not found is included literally. Applying a patch
+to the same old volumes rebuilds new volumes bit for bit, result is
+verified against SHA-1 in volume header.
+
+Patch file layout::
+
+    'aardelta'                          magic
+    >L                                  length of patch metadata
+    patch metadata                      zlib compressed JSON
+    operations                          zlib compressed stream
+
+Operations are
+
+    'c' >HQL   copy length bytes at offset of old volume n
+    'd' >L     followed by literal data of given length
+    'e'        end of current new volume
+
+"""
+import sys
+import os
+import json
+import struct
+import zlib
+import hashlib
+import heapq
+import itertools
+import operator
+import argparse
+
+from aarddict.dictionary import HEADER_SPEC, spec_len
+
+from aardtools.compiler import VolumeReader, NO_BLOCK, collation_key
+
+MAGIC = 'aardelta'
+PATCH_META_LENGTH_FORMAT = '>L'
+
+OP_COPY = 'c'
+OP_DATA = 'd'
+OP_END = 'e'
+
+OLD, NEW = 0, 1
+
+COPY_FORMAT = '>HQL'
+DATA_LENGTH_FORMAT = '>L'
+
+MAX_DATA_LEN = 1 << 20
+READ_CHUNK_LEN = 1 << 16
+
+SHA1_OFFSET = spec_len(HEADER_SPEC[:2])
+SHA1_FIELD = slice(spec_len(HEADER_SPEC[:1]), SHA1_OFFSET)
+
+
+def unit_digest(data):
+    return hashlib.sha1(data).digest()[:12]
+
+
+def payload_digests(reader, side):
+    """
+    Yield (collation key, side, title, hash of stored payload) of
+    titles of given volume in index order. Payload of articles
+    stored in blocks includes the whole block.
+    """
+    for i, title in enumerate(reader.titles()):
+        _index2_ptr, article_ptr, block_offset = reader.item(i)
+        digest = unit_digest(reader.stored(article_ptr))
+        if block_offset != NO_BLOCK:
+            digest += struct.pack('>L', block_offset)
+        yield collation_key(title).getByteArray(), side, title, digest
+
+
+def compare(old_readers, new_readers):
+    """
+    Count added, removed, changed and unchanged titles. Indexes of
+    all volumes are merged in collation order and titles are
+    compared within groups of equal collation keys, so that only
+    one such group is in memory at a time.
+    """
+    stats = dict(added=0, removed=0, changed=0, unchanged=0)
+    merged = heapq.merge(*([payload_digests(reader, OLD)
+                            for reader in old_readers] +
+                           [payload_digests(reader, NEW)
+                            for reader in new_readers]))
+    for _key, group in itertools.groupby(merged, operator.itemgetter(0)):
+        old_digests = {}
+        new_titles = set()
+        for _key, side, title, digest in group:
+            if side == OLD:
+                old_digests[title] = digest
+                continue
+            new_titles.add(title)
+            old_digest = old_digests.get(title)
+            if old_digest is None:
+                stats['added'] += 1
+            elif old_digest == digest:
+                stats['unchanged'] += 1
+            else:
+                stats['changed'] += 1
+        stats['removed'] += len(set(old_digests) - new_titles)
+    return stats
+
+
+class PatchWriter(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.compressor = zlib.compressobj(9)
+        self.pending_copy = None
+        self.pending_data = []
+        self.pending_data_len = 0
+
+    def _write(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def _flush_copy(self):
+        if self.pending_copy:
+            self._write(OP_COPY + struct.pack(COPY_FORMAT,
+                                              *self.pending_copy))
+            self.pending_copy = None
+
+    def _flush_data(self):
+        if self.pending_data:
+            self._write(OP_DATA + struct.pack(DATA_LENGTH_FORMAT,
+                                              self.pending_data_len))
+            for data in self.pending_data:
+                self._write(data)
+            self.pending_data = []
+            self.pending_data_len = 0
+
+    def copy(self, n, offset, length):
+        if self.pending_copy:
+            pending_n, pending_offset, pending_length = self.pending_copy
+            if (pending_n == n and
+                pending_offset + pending_length == offset):
+                self.pending_copy = (n, pending_offset,
+                                     pending_length + length)
+                return
+        self._flush_data()
+        self._flush_copy()
+        self.pending_copy = (n, offset, length)
+
+    def data(self, data):
+        self._flush_copy()
+        while data:
+            chunk = data[:MAX_DATA_LEN - self.pending_data_len]
+            data = data[len(chunk):]
+            self.pending_data.append(chunk)
+            self.pending_data_len += len(chunk)
+            if self.pending_data_len == MAX_DATA_LEN:
+                self._flush_data()
+
+    def end(self):
+        self._flush_data()
+        self._flush_copy()
+        self._write(OP_END)
+
+    def close(self):
+        self.f.write(self.compressor.flush())
+
+
+class PatchReader(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = zlib.decompressobj()
+        self.buffer = ''
+        self.pos = 0
+
+    def read(self, length):
+        while len(self.buffer) - self.pos < length:
+            chunk = self.f.read(READ_CHUNK_LEN)
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                if len(self.buffer) < length:
+                    raise ValueError('Truncated patch')
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        data = self.buffer[self.pos:self.pos+length]
+        self.pos += length
+        return data
+
+    def operations(self):
+        copy_len = struct.calcsize(COPY_FORMAT)
+        data_len = struct.calcsize(DATA_LENGTH_FORMAT)
+        while True:
+            op = self.read(1)
+            if op == OP_COPY:
+                yield op, struct.unpack(COPY_FORMAT, self.read(copy_len))
+            elif op == OP_DATA:
+                length = struct.unpack(DATA_LENGTH_FORMAT,
+                                       self.read(data_len))[0]
+                yield op, self.read(length)
+            elif op == OP_END:
+                yield op, None
+                return
+            else:
+                raise ValueError('Unknown patch operation %r' % op)
+
+
+def make(old_file_names, new_file_names, patch_file_name):
+    old_readers = [VolumeReader(name) for name in old_file_names]
+    new_readers = [VolumeReader(name) for name in new_file_names]
+    try:
+        return _make(old_readers, new_readers, patch_file_name)
+    finally:
+        for reader in old_readers + new_readers:
+            reader.close()
+
+
+def _make(old_readers, new_readers, patch_file_name):
+    stats = compare(old_readers, new_readers)
+    units = {}
+    for n, reader in enumerate(old_readers):
+        for offset, length in reader.units():
+            digest = unit_digest(reader.data[offset:offset+length])
+            units.setdefault(digest, (n, offset, length))
+
+    patch_meta = dict(
+        old=[reader.header['sha1sum'] for reader in old_readers],
+        new=[dict(name=os.path.basename(reader.file_name),
+                  sha1sum=reader.header['sha1sum'],
+                  size=len(reader.data))
+             for reader in new_readers],
+        stats=stats)
+    serialized_meta = zlib.compress(json.dumps(patch_meta))
+
+    copied = 0
+    with open(patch_file_name, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack(PATCH_META_LENGTH_FORMAT, len(serialized_meta)))
+        f.write(serialized_meta)
+        writer = PatchWriter(f)
+        for reader in new_readers:
+            data = reader.data
+            pos = reader.article_offset
+            writer.data(data[:pos])
+            for offset, length in reader.units():
+                unit = data[offset:offset+length]
+                old = units.get(unit_digest(unit))
+                if old and old[2] == length:
+                    writer.copy(*old)
+                    copied += length
+                else:
+                    writer.data(unit)
+                pos = offset + length
+            writer.data(data[pos:])
+            writer.end()
+        writer.close()
+    stats['copied'] = copied
+    return stats
+
+
+def read_patch_meta(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a dictionary patch')
+    meta_length_len = struct.calcsize(PATCH_META_LENGTH_FORMAT)
+    meta_length = struct.unpack(PATCH_META_LENGTH_FORMAT,
+                                f.read(meta_length_len))[0]
+    return json.loads(zlib.decompress(f.read(meta_length)))
+
+
+def apply(old_file_names, patch_file_name, output_dir):
+    old_readers = [VolumeReader(name) for name in old_file_names]
+    try:
+        return _apply(old_readers, patch_file_name, output_dir)
+    finally:
+        for reader in old_readers:
+            reader.close()
+
+
+def _apply(old_readers, patch_file_name, output_dir):
+    with open(patch_file_name, 'rb') as f:
+        patch_meta = read_patch_meta(f)
+        available = dict((reader.header['sha1sum'], reader)
+                         for reader in old_readers)
+        missing = [sha1sum for sha1sum in patch_meta['old']
+                   if sha1sum not in available]
+        if missing:
+            raise ValueError('Patch requires old volumes with sha1 %s'
+                             % ', '.join(missing))
+        sources = [available[sha1sum].data
+                   for sha1sum in patch_meta['old']]
+        patch = PatchReader(f)
+        output_file_names = []
+        for volume in patch_meta['new']:
+            output_file_name = os.path.join(output_dir, volume['name'])
+            tmp_file_name = output_file_name + '.tmp'
+            sha1 = hashlib.sha1()
+            header = []
+            pos = 0
+            with open(tmp_file_name, 'wb') as out:
+                for op, arg in patch.operations():
+                    if op == OP_END:
+                        break
+                    if op == OP_COPY:
+                        n, offset, length = arg
+                        data = sources[n][offset:offset+length]
+                    else:
+                        data = arg
+                    if pos < SHA1_OFFSET:
+                        header.append(data[:SHA1_OFFSET - pos])
+                        sha1.update(data[SHA1_OFFSET - pos:])
+                    else:
+                        sha1.update(data)
+                    out.write(data)
+                    pos += len(data)
+            header_sha1sum = ''.join(header)[SHA1_FIELD]
+            if (pos != volume['size'] or
+                header_sha1sum != volume['sha1sum'] or
+                sha1.hexdigest() != header_sha1sum):
+                os.remove(tmp_file_name)
+                raise ValueError('%s: sha1 mismatch, patch does not apply'
+                                 % volume['name'])
+            os.rename(tmp_file_name, output_file_name)
+            output_file_names.append(output_file_name)
+    return output_file_names
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(
+        description='Make and apply binary patches between two versions '
+        'of a compiled dictionary')
+    subparsers = parser.add_subparsers(dest='command')
+
+    make_parser = subparsers.add_parser(
+        'make', help='Compare two versions of a dictionary and '
+        'write a patch')
+    make_parser.add_argument('--old', nargs='+', required=True,
+                             metavar='VOLUME',
+                             help='Volumes of previous dictionary version')
+    make_parser.add_argument('--new', nargs='+', required=True,
+                             metavar='VOLUME',
+                             help='Volumes of new dictionary version')
+    make_parser.add_argument('-o', '--output', required=True,
+                             help='Patch file name')
+
+    apply_parser = subparsers.add_parser(
+        'apply', help='Rebuild new dictionary volumes from previous '
+        'version and a patch')
+    apply_parser.add_argument('--old', nargs='+', required=True,
+                              metavar='VOLUME',
+                              help='Volumes of previous dictionary version')
+    apply_parser.add_argument('patch', help='Patch file name')
+    apply_parser.add_argument('-d', '--output-dir', default='.',
+                              help='Directory to write new volumes to. '
+                              'Default: %(default)s')
+    return parser
+
+
+def main():
+    args = make_argparser().parse_args()
+    try:
+        if args.command == 'make':
+            stats = make(args.old, args.new, args.output)
+            sys.stdout.write('added: %(added)d, removed: %(removed)d, '
+                             'changed: %(changed)d, '
+                             'unchanged: %(unchanged)d\n' % stats)
+            sys.stdout.write('%s: %d bytes, %d bytes copied from old '
+                             'volumes\n' % (args.output,
+                                            os.path.getsize(args.output),
+                                            stats['copied']))
+        else:
+            for file_name in apply(args.old, args.patch, args.output_dir):
+                sys.stdout.write('%s: sha1 ok\n' % file_name)
+    except ValueError, e:
+        sys.stderr.write('%s\n' % e)
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,8 @@ import lxml.html.clean
 
 from lxml.cssselect import CSSSelector
 
-from aardtools.compiler import ArticleSource, Article
+from aardtools.compiler import (ArticleSource, Article, PreparedArticle,
+                                ResumeError, prepare, positioned)
 from aardtools.wiki import tex
 
 tojson = functools.partial(json.dumps, ensure_ascii=False)
@@ -97,6 +98,8 @@ def process_initializer(css_selectors):
 
 class CouchArticleSource(ArticleSource, collections.Sized):
 
+    resumable = True
+
     def __init__(self, args):
         super(CouchArticleSource, self).__init__(self)
         self.couch, siteinfo_couch = mkcouch(args.input_files[0])
@@ -104,6 +107,13 @@ class CouchArticleSource(ArticleSource, collections.Sized):
         self.endkey = args.endkey
         self.key = args.key
         self.key_file = args.key_file
+        self.prepare_in_workers = getattr(args, 'prepare_in_workers', False)
+        #results are taken in order of keys if compilation
+        #may be resumed after last key processed
+        self.ordered = bool(getattr(args, 'checkpoint_interval', 0))
+        self.position = None
+        self.resume_key = None
+        self.resume_lines = 0
 
         self.filters = []
 
@@ -185,7 +195,7 @@ class CouchArticleSource(ArticleSource, collections.Sized):
         return self._metadata
 
     def __len__(self):
-        if self.key:
+        if self.key is not None:
             return len(self.key)
         if self.key_file:
             with open(os.path.expanduser(self.key_file)) as f:
@@ -196,6 +206,22 @@ class CouchArticleSource(ArticleSource, collections.Sized):
     def len_includes_redirects(self):
         return False
 
+    def resume(self, position):
+        if 'lines' in position:
+            self.resume_lines = position['lines']
+        elif self.key is not None:
+            keys = [key.decode('utf8') for key in self.key]
+            try:
+                i = keys.index(position['key'])
+            except ValueError:
+                raise ResumeError('checkpoint key %s is not one of '
+                                  'requested keys'
+                                  % position['key'].encode('utf8'))
+            #empty after the last key, nothing is left to compile
+            self.key = self.key[i + 1:]
+        else:
+            self.startkey = self.resume_key = position['key']
+
     def __iter__(self):
         basic_view_args = {
             'stale': 'ok',
@@ -206,7 +232,9 @@ class CouchArticleSource(ArticleSource, collections.Sized):
             view_args['startkey'] = self.startkey
         if self.endkey:
             view_args['endkey'] = self.endkey
-        if self.key:
+        if self.key is not None:
+            if not self.key:
+                return
             view_args['keys'] = self.key
 
         def articles_from_viewiter(viewiter):
@@ -232,44 +260,79 @@ class CouchArticleSource(ArticleSource, collections.Sized):
                     yield result
 
         if self.key_file:
+            #(position, item), position is only known
+            #after each group of keys
             def articles():
                 with open(os.path.expanduser(self.key_file)) as f:
+                    lines = itertools.islice(f, self.resume_lines, None)
+                    consumed = self.resume_lines
                     for key_group in grouper(
                             (line.strip().replace('_', ' ')
-                             for line in f if line), 50):
+                             for line in lines if line), 50):
+                        consumed += sum(1 for key in key_group
+                                        if key is not None)
                         query_args = dict(basic_view_args)
                         query_args['keys'] = [key for key in key_group if key]
                         keys_found = set()
                         viewiter = self.couch.iterview(
                             '_all_docs', len(query_args['keys']), **query_args)
+                        group = []
                         for item in articles_from_viewiter(viewiter):
                             keys_found.add(item[0])
-                            yield item
+                            group.append(item)
                         for key in (set(query_args['keys']) - keys_found):
-                            yield key, None, None, False
+                            group.append((key, None, None, False))
                         keys_found.clear()
+                        for i, item in enumerate(group):
+                            if i == len(group) - 1:
+                                yield {'lines': consumed}, item
+                            else:
+                                yield None, item
         else:
             def articles():
                 viewiter = self.couch.iterview(
                     '_all_docs', 50, **view_args)
                 for item in articles_from_viewiter(viewiter):
-                    yield item
+                    #start key is included in view results
+                    if item[0] != self.resume_key:
+                        yield {'key': item[0]}, item
+
+        #positions of items submitted to pool, matching
+        #results are taken in the same order if pool is ordered
+        positions = collections.deque()
+
+        def track(items):
+            for position, item in items:
+                positions.append(position)
+                yield item
 
         pool = multiprocessing.Pool(None, process_initializer, [self.filters])
+        imap = pool.imap if self.ordered else pool.imap_unordered
         try:
-            resulti = pool.imap_unordered(clean_and_handle_errors, articles())
+            resulti = imap(
+                clean_and_prepare if self.prepare_in_workers
+                else clean_and_handle_errors, track(articles()))
             while True:
                 try:
                     title, aliases, text = resulti.next()
                 except ConvertError as cerr:
-                    yield Article(cerr.title, '', failed=True)
+                    items = [Article(cerr.title, '', failed=True)]
                 else:
-                    serialized = tojson((text, [])) if text else None
-                    yield Article(title, serialized, isredirect=False)
+                    if isinstance(text, tuple):
+                        compressed, sort_key = text
+                        items = [PreparedArticle(title, compressed, sort_key)]
+                    else:
+                        serialized = tojson((text, [])) if text else None
+                        items = [Article(title, serialized, isredirect=False)]
                     if aliases:
                         for name in aliases:
                             serialized = tojson(('', [], {u'r': title}))
-                            yield Article(name, serialized, isredirect=True)
+                            items.append(Article(name, serialized,
+                                                 isredirect=True))
+                position = positions.popleft()
+                for item in positioned(self, items,
+                                       position if self.ordered else None):
+                    yield item
         except StopIteration:
             raise
         except:
@@ -291,6 +354,17 @@ def clean_and_handle_errors((title, aliases, text, rtl)):
         raise ConvertError(title)
 
 
+def clean_and_prepare(args):
+    """
+    Clean up article and, if it's not empty, compress it and
+    compute title sort key in this worker process
+    """
+    title, aliases, text = clean_and_handle_errors(args)
+    if text:
+        text = prepare(title, tojson((text, [])))
+    return title, aliases, text
+
+
 NEWLINE_RE = re.compile(r'[\n]{2,}')
 
 SEL_IMG_TEX = CSSSelector('img.tex')
@@ -20,7 +20,7 @@ import os
 import urlparse
 import collections
 
-from itertools import islice
+from itertools import islice, chain
 import json
 
 import yaml
@@ -64,6 +64,8 @@ known_licenses = {
 
 
 wikidb = None
+#ReuseDigests of previous build, tells which inputs are unchanged
+reuse_digests = None
 log = logging.getLogger('wiki')
 
 def _create_wikidb(cdbdir, lang, rtl, filters, skip_refs=False):
@@ -107,15 +109,25 @@ def mkredirect(title, redirect_target):
     return title, tojson(('', [], meta)), True, None
 
 def convert(title):
+    """
+    Return title, serialized article, whether it's a redirect,
+    language links and source digest. Serialized article is None
+    if article is empty or, if source digest is not None, unchanged
+    since previous build.
+    """
     try:
         text = wikidb.reader[title]
 
         if not text:
-            return title, None, False, None
+            return title, None, False, None, None
+
+        digest = source_digest(title, text)
+        if reuse_digests and reuse_digests.unchanged(title, digest):
+            return title, None, False, None, digest
 
         redirect = wikidb.get_redirect(text)
         if redirect:
-            return mkredirect(title, redirect)
+            return mkredirect(title, redirect) + (digest,)
 
         mwobject = uparser.parseString(title=title,
                                        raw=text,
@@ -140,7 +152,28 @@ def convert(title):
         log.exception('Failed to process article %s', title.encode('utf8'))
         raise ConvertError(title)
     else:
-        return title, tojson((text.rstrip(), tags)), False, languagelinks
+        return (title, tojson((text.rstrip(), tags)), False, languagelinks,
+                digest)
+
+
+def convert_and_prepare(title):
+    """
+    Convert article and, unless it's a redirect, compress it and
+    compute title sort key in this worker process
+    """
+    title, serialized, redirect, languagelinks, digest = convert(title)
+    if serialized and not redirect:
+        serialized = prepare(title, serialized)
+    return title, serialized, redirect, languagelinks, digest
+
+
+def mkarticle(title, serialized, redirect, digest=None):
+    if isinstance(serialized, tuple):
+        compressed, sort_key = serialized
+        return PreparedArticle(title, compressed, sort_key,
+                               isredirect=redirect, source_digest=digest)
+    return Article(title, serialized, isredirect=redirect,
+                   source_digest=digest)
 
 
 class BadRedirect(ConvertError): pass
@@ -325,11 +358,16 @@ def fix_server_url(general_siteinfo):
     return server
 
 
-from aardtools.compiler import ArticleSource, Article
+from aardtools.compiler import (ArticleSource, Article, PreparedArticle,
+                               prepare, positioned, source_digest)
 
 
 class MediawikiArticleSource(ArticleSource, collections.Sized):
 
+    resumable = True
+
+    reuses_previous = True
+
     @classmethod
     def name(cls):
         return 'wiki'
@@ -448,6 +486,13 @@ class MediawikiArticleSource(ArticleSource, collections.Sized):
     def metadata(self):
         return self.wiki_parser.metadata
 
+    @property
+    def position(self):
+        return self.wiki_parser.position
+
+    def resume(self, position):
+        self.wiki_parser.resume(position)
+
     def __len__(self):
         if self.wiki_parser.requested_article_count:
             return self.wiki_parser.requested_article_count
@@ -474,6 +519,9 @@ class MediawikiArticleSource(ArticleSource, collections.Sized):
         return self.parse(self.input_file)
 
     def parse(self, f):
+        global reuse_digests
+        reuse_digests = self.previous and self.previous.reuse_digests
+        self.wiki_parser.previous = self.previous
         for article in self.wiki_parser.parse(f):
             yield article
 
@@ -562,9 +610,18 @@ class WikiParser():
 
         self.metadata['mwlib'] = '.'.join(str(v) for v in mwlib_version)
         self.processes = options.processes if options.processes else None
+        self.prepare_in_workers = getattr(options, 'prepare_in_workers', False)
         self.pool = None
         self.start = options.start
         self.end = options.end
+        #results are taken in order of titles if compilation
+        #may be resumed after number of titles consumed
+        self.ordered = bool(getattr(options, 'checkpoint_interval', 0))
+        self.position = None
+        self.resume_titles = 0
+        self.resume_article_count = 0
+        #PreviousBuild to take unchanged articles from
+        self.previous = None
         if options.nomp:
             log.info('Disabling multiprocessing')
             self.parse = self.parse_simple
@@ -586,7 +643,18 @@ class WikiParser():
             self.requested_titles = None
 
 
+    def resume(self, position):
+        self.resume_titles = position['titles']
+        self.resume_article_count = position.get('articles', 0)
+
     def articles(self, cdbdir):
+        titles = self.titles(cdbdir)
+        if self.resume_titles:
+            log.info('Resuming after %d titles', self.resume_titles)
+            titles = islice(titles, self.resume_titles, None)
+        return titles
+
+    def titles(self, cdbdir):
         if self.start > 0:
             log.info('Skipping to article %d', self.start)
         _create_wikidb(cdbdir, self.lang, self.rtl, self.filters, self.skip_refs)
@@ -606,15 +674,24 @@ class WikiParser():
     def parse_simple(self, cdbdir):
         _create_wikidb(cdbdir, self.lang, self.rtl, self.filters, self.skip_refs)
         articles = self.articles(cdbdir)
+        consumed = self.resume_titles
         for a in articles:
+            consumed += 1
             try:
                 result = convert(a)
-                title, serialized, redirect, langugagelinks = result
-                yield Article(title, serialized, isredirect=redirect)
-                for item in self.process_languagelinks(title, langugagelinks):
-                    yield item
+                title, serialized, redirect, langugagelinks, digest = result
+                if serialized is None and digest:
+                    items = self.previous.articles(title)
+                else:
+                    items = chain(
+                        [Article(title, serialized, isredirect=redirect,
+                                 source_digest=digest)],
+                        self.process_languagelinks(title, langugagelinks,
+                                                   digest))
             except ConvertError as e:
-                yield Article(e.title, None, failed=True)
+                items = [Article(e.title, None, failed=True)]
+            for item in positioned(self, items, dict(titles=consumed)):
+                yield item
 
 
     def parse_mp(self, cdbdir):
@@ -625,29 +702,45 @@ class WikiParser():
                              initargs=[cdbdir, self.lang, self.rtl, self.filters,
                                        log.getEffectiveLevel(), self.skip_refs],
                              maxtasksperchild=100000)
-            real_article_count = 0
-            resulti = self.pool.imap_unordered(convert, articles)
+            real_article_count = self.resume_article_count
+            consumed = self.resume_titles
+            imap = self.pool.imap if self.ordered else self.pool.imap_unordered
+            resulti = imap(
+                convert_and_prepare if self.prepare_in_workers else convert,
+                articles)
             while True:
+                items = ()
                 try:
                     result = resulti.next()
-                    title, serialized, redirect, langugagelinks  = result
-                    if not redirect or not self.requested_article_count:
+                    consumed += 1
+                    (title, serialized, redirect,
+                     langugagelinks, digest) = result
+                    if serialized is None and digest:
                         real_article_count += 1
-                        yield Article(title, serialized, isredirect=redirect)
-                        for item in self.process_languagelinks(title, langugagelinks):
-                            yield item
-                        if (self.requested_article_count and
-                            real_article_count >= self.requested_article_count):
-                            break
+                        items = self.previous.articles(title)
+                    elif not redirect or not self.requested_article_count:
+                        real_article_count += 1
+                        items = chain(
+                            [mkarticle(title, serialized, redirect, digest)],
+                            self.process_languagelinks(title, langugagelinks,
+                                                       digest))
                 except ConvertError as e:
-                    yield Article(e.title, None, failed=True)
+                    consumed += 1
+                    items = [Article(e.title, None, failed=True)]
+                position = (dict(titles=consumed, articles=real_article_count)
+                            if self.ordered else None)
+                for item in positioned(self, items, position):
+                    yield item
+                if (self.requested_article_count and
+                    real_article_count >= self.requested_article_count):
+                    break
         except:
             log.exception('')
             raise
         finally:
             self.pool.terminate()
 
-    def process_languagelinks(self, title, languagelinks):
+    def process_languagelinks(self, title, languagelinks, digest=None):
         if not languagelinks:
             return
         targets = set()
@@ -670,4 +763,5 @@ class WikiParser():
              _redirect, _langugagelinks) = mkredirect(
                 wikidb.nshandler.get_fqname(target), title)
             yield Article(l_title, l_serialized,
-                                      isredirect=True, counted=False)
+                                      isredirect=True, counted=False,
+                                      source_digest=digest)
@@ -32,10 +32,12 @@ from itertools import combinations
 tojson = functools.partial(json.dumps, ensure_ascii=False)
 
 import collections
-from aardtools.compiler import ArticleSource, Article
+from aardtools.compiler import ArticleSource, Article, positioned
 
 class XdxfArticleSource(ArticleSource, collections.Sized):
 
+    resumable = True
+
     @classmethod
     def name(cls):
         return 'xdxf'
@@ -59,6 +61,13 @@ class XdxfArticleSource(ArticleSource, collections.Sized):
     def metadata(self):
         return self.xdxf_parser.metadata
 
+    @property
+    def position(self):
+        return self.xdxf_parser.position
+
+    def resume(self, position):
+        self.xdxf_parser.skip_entries = position['entries']
+
     def __len__(self):
         count = 0
         f = make_input(self.input_file)
@@ -161,6 +170,9 @@ class XDXFParser():
     def __init__(self, options):
         self.options = options
         self.metadata = {}
+        self.position = None
+        #number of leading ar elements that were already compiled
+        self.skip_entries = 0
 
     def _mkabbrs(self, element):
         abbrs = {}
@@ -218,6 +230,7 @@ class XDXFParser():
 
     def parse(self, f):
         abbreviations = {}
+        entries = 0
         for _, element in etree.iterparse(f):
             if element.tag == 'description':
                 self.metadata[element.tag] = element.text
@@ -237,6 +250,10 @@ class XDXFParser():
                 abbreviations = self._mkabbrs(element)
 
             if element.tag == 'ar':
+                entries += 1
+                if entries <= self.skip_entries:
+                    element.clear()
+                    continue
                 txt = self._text(element, abbreviations)
                 txt = txt.replace('\n', '<br/>')
                 titles = []
@@ -252,16 +269,18 @@ class XDXFParser():
                 if titles:
                     first_title = titles[0]
                     serialized = tojson((txt, [], {}))
-                    yield Article(first_title, serialized)
-                    titles = titles[1:]
-                    if titles:
-                        for title in titles:
-                            logging.debug('Redirect %s ==> %s',
-                                          title.encode('utf8'),
-                                          first_title.encode('utf8'))
-                            meta = {u'r': first_title}
-                            serialized = tojson(('', [], meta))
-                            yield Article(title, serialized, isredirect=True)
+                    articles = [Article(first_title, serialized)]
+                    for title in titles[1:]:
+                        logging.debug('Redirect %s ==> %s',
+                                      title.encode('utf8'),
+                                      first_title.encode('utf8'))
+                        meta = {u'r': first_title}
+                        serialized = tojson(('', [], meta))
+                        articles.append(Article(title, serialized,
+                                                isredirect=True))
+                    for article in positioned(self, articles,
+                                              {'entries': entries}):
+                        yield article
                 else:
                     logging.warn('No title found in article:\n%s',
                                  etree.tostring(element, encoding='utf8'))
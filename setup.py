@@ -19,6 +19,7 @@ setup(
     entry_points = {
         'console_scripts': ['aardcompile = aardtools.compiler:main',
                             'aardc = aardtools.compiler:main',
+                            'aard-delta = aardtools.delta:main',
                             'aard-siteinfo = aardtools.wiki.fetchsiteinfo:main',
                             ]
     },
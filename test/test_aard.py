@@ -0,0 +1,51 @@
+import argparse
+import os
+import uuid
+
+from icu import ICU_VERSION
+
+from aardtools.aard import AardArticleSource
+from aardtools.compiler import DummyArticleSource, Volume, VolumeReader
+
+from test_compiler import compile_volumes, with_work_dir
+
+
+def stored_articles(file_name):
+    reader = VolumeReader(file_name)
+    articles = [(title, reader.stored(reader.item(i)[1]))
+                for i, title in enumerate(reader.titles())]
+    reader.close()
+    return articles
+
+
+@with_work_dir
+def test_passthrough_copies_stored_articles(work_dir):
+    input_dir = os.path.join(work_dir, 'input')
+    os.mkdir(input_dir)
+    (input_file, _articles), = compile_volumes(
+        input_dir, DummyArticleSource(argparse.Namespace(len=2000)),
+        max_file_size=10**6)
+    source = AardArticleSource(argparse.Namespace(
+        input_files=[os.path.join(input_dir, input_file)], passthrough=True))
+    assert source.presorted
+    assert source.same_collation
+    volumes = compile_volumes(work_dir, source)
+    assert len(volumes) > 1
+    copied = []
+    for file_name, _articles in volumes:
+        copied.extend(stored_articles(os.path.join(work_dir, file_name)))
+    assert copied == stored_articles(os.path.join(input_dir, input_file))
+
+
+@with_work_dir
+def test_passthrough_checks_order_collated_by_other_icu(work_dir):
+    for icu_version in (ICU_VERSION, None, '1.0'):
+        volume = Volume(uuid.uuid4(), 100, 10**6, work_dir)
+        volume.add('a', 'text')
+        metadata = {'icu_version': icu_version} if icu_version else {}
+        file_name = volume.finalize(os.path.join(work_dir, 'test.aar'),
+                                    metadata)
+        source = AardArticleSource(argparse.Namespace(
+            input_files=[file_name], passthrough=True))
+        assert source.same_collation == (icu_version == ICU_VERSION)
+        os.remove(file_name)
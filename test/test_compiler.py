@@ -0,0 +1,725 @@
+import argparse
+import functools
+import glob
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import uuid
+import zlib
+from StringIO import StringIO
+
+from aarddict.dictionary import HEADER_SPEC, calcsha1, spec_len
+
+from icu import Collator, Locale
+
+from aardtools import compiler
+from aardtools.compiler import (BASE_CODECS, COLLATION_STRENGTHS,
+                                EXTENT_CHECKSUMS, FRONT_CODING_BLOCK,
+                                NO_BLOCK, BloomFilter, CodecSelector,
+                                CollationKeys, CompressionPipeline,
+                                DummyArticleSource, JumpTable, Volume,
+                                VolumeReader, bloom_hashes, collation_key,
+                                payload_digest, positions, run_codecs,
+                                primary_collation_key, sort_records)
+
+
+def with_work_dir(test):
+    """
+    Call test with temporary work directory, removed when test is done
+    """
+    @functools.wraps(test)
+    def run():
+        work_dir = tempfile.mkdtemp()
+        try:
+            test(work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+    return run
+
+
+def test_codec_selector_samples_then_settles():
+    selector = CodecSelector(3, 0)
+    text = 'abc' * 100
+    for i in range(3):
+        codecs, measure = selector.select(False, len(text), BASE_CODECS)
+        assert codecs == BASE_CODECS
+        assert measure
+        codec, _compressed, measurements = run_codecs(text, codecs, measure)
+        selector.record(False, len(text), codec, measurements)
+    codecs, measure = selector.select(False, len(text), BASE_CODECS)
+    assert len(codecs) == 1
+    assert not measure
+
+
+def test_codec_selector_resamples():
+    selector = CodecSelector(1, 2)
+    text = 'abc' * 100
+    codecs, measure = selector.select(True, len(text), BASE_CODECS)
+    codec, _compressed, measurements = run_codecs(text, codecs, measure)
+    selector.record(True, len(text), codec, measurements)
+    codecs, measure = selector.select(True, len(text), BASE_CODECS)
+    assert measure
+    codecs, measure = selector.select(True, len(text), BASE_CODECS)
+    assert not measure
+
+
+def test_codec_selector_buckets_by_kind():
+    selector = CodecSelector(1, 0)
+    text = 'abc' * 100
+    codecs, measure = selector.select(True, len(text), BASE_CODECS)
+    codec, _compressed, measurements = run_codecs(text, codecs, measure)
+    selector.record(True, len(text), codec, measurements)
+    _codecs, measure = selector.select(False, len(text), BASE_CODECS)
+    assert measure
+
+
+def test_compression_pipeline_keeps_submission_order():
+    pipeline = CompressionPipeline(3, window=10)
+    last_submitted_done = threading.Event()
+    done = []
+    def compress(i):
+        #first item can't finish before the last one
+        if i == 0:
+            last_submitted_done.wait(10)
+        done.append(i)
+        if i == 2:
+            last_submitted_done.set()
+        return 'compressed %d' % i
+    results = []
+    for i in range(3):
+        pipeline.submit(i, compress, (i,))
+        results.extend(pipeline.ready())
+    pipeline.put(3, 'uncompressed 3')
+    results.extend(pipeline.drain())
+    pipeline.close()
+    assert done[-1] == 0
+    assert results == [(0, 'compressed 0'), (1, 'compressed 1'),
+                       (2, 'compressed 2'), (3, 'uncompressed 3')]
+    assert not pipeline.running
+
+
+@with_work_dir
+def test_threaded_compression_rolls_over_volumes(work_dir):
+    serial_work_dir = os.path.join(work_dir, 'serial')
+    threaded_work_dir = os.path.join(work_dir, 'threaded')
+    os.mkdir(serial_work_dir)
+    os.mkdir(threaded_work_dir)
+    expected = compile_volumes(
+        serial_work_dir, DummyArticleSource(argparse.Namespace(len=2000)))
+    #volume fills up while many articles are still being compressed
+    volumes = compile_volumes(
+        threaded_work_dir, DummyArticleSource(argparse.Namespace(len=2000)),
+        compress_threads=4)
+    assert len(volumes) > 3
+    assert volumes == expected
+    for file_name, _articles in volumes:
+        assert os.path.getsize(os.path.join(threaded_work_dir,
+                                            file_name)) <= 4000
+
+
+@with_work_dir
+def test_volume_resumes_from_checkpoint(work_dir):
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir)
+    volume.add('a', 'aaa')
+    state = volume.checkpoint()
+    volume.add('b', 'bbb')
+    for f in (volume.index1, volume.index2, volume.articles):
+        f.close()
+    restored = Volume(uuid.uuid4(), 100, 10**6, work_dir, state=state)
+    assert restored.number == volume.number
+    assert restored.index_count == 1
+    restored.add('c', 'ccc')
+    for f in (restored.index1, restored.index2, restored.articles):
+        f.flush()
+    assert os.path.getsize(restored.articles.name) == 14
+    assert restored.articles_len == 14
+    restored.index2.seek(0)
+    assert restored.index2.read() == '\x00\x01a\x00\x01c'
+
+
+def read_volume(volume, work_dir):
+    file_name = volume.finalize(os.path.join(work_dir, 'test.aar'), {})
+    return VolumeReader(file_name)
+
+
+@with_work_dir
+def test_volume_roundtrip_with_blocks(work_dir):
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir, block_size=64)
+    articles = {}
+    for i in range(20):
+        title = 't%02d' % i
+        articles[title] = 'article %d ' % i * (i % 3 + 1)
+        if i % 4:
+            volume.add_to_block(title, articles[title])
+        else:
+            volume.add(title, articles[title])
+    reader = read_volume(volume, work_dir)
+    titles = list(reader.titles())
+    items = [reader.item(i) for i in range(len(reader))]
+    assert reader.version == 2
+    assert titles == sorted(articles)
+    #read backwards so that blocks are decompressed again
+    for i in reversed(range(len(reader))):
+        assert reader.article(i) == articles[titles[i]]
+    reader.close()
+    in_blocks = [title for title, (_index2_ptr, _article_ptr, offset)
+                 in zip(titles, items) if offset != NO_BLOCK]
+    assert in_blocks == [title for i, title in enumerate(titles) if i % 4]
+    block_offsets = [offset for _index2_ptr, _article_ptr, offset
+                     in items if offset != NO_BLOCK]
+    assert 0 in block_offsets
+    assert max(block_offsets) > 0
+    assert len(set(ptr for _index2_ptr, ptr, _offset in items)) < 20
+
+
+@with_work_dir
+def test_volume_roundtrip_with_index_reserve(work_dir):
+    output_file_name = os.path.join(work_dir, 'test.aar')
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir,
+                    output_file_name=output_file_name,
+                    index_reserve=1000)
+    articles = dict(('t%02d' % i, 'article %d' % i) for i in range(20))
+    for title in reversed(sorted(articles)):
+        volume.add(title, articles[title])
+    reader = read_volume(volume, work_dir)
+    assert reader.article_offset == 1000
+    titles = list(reader.titles())
+    assert titles == sorted(articles)
+    for i, title in enumerate(titles):
+        assert reader.article(i) == articles[title]
+    reader.close()
+
+
+@with_work_dir
+def test_volume_roundtrip_with_front_coded_index(work_dir):
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir, block_size=256,
+                    front_coded_index=True)
+    count = 2*FRONT_CODING_BLOCK + 3
+    articles = dict(('prefix %03d' % i, 'article %d' % i)
+                    for i in range(count))
+    #shorter titles that are prefixes of others
+    articles['prefix'] = 'article'
+    articles['prefix 01'] = 'article 01'
+    for i, title in enumerate(sorted(articles, reverse=True)):
+        if i % 2:
+            volume.add_to_block(title, articles[title])
+        else:
+            volume.add(title, articles[title])
+    reader = read_volume(volume, work_dir)
+    assert reader.version == 3
+    assert reader.metadata['front_coding_block'] == FRONT_CODING_BLOCK
+    titles = list(reader.titles())
+    assert titles == sorted(articles)
+    for i, title in enumerate(titles):
+        assert reader.title(i) == title
+        assert reader.article(i) == articles[title]
+    reader.close()
+
+
+@with_work_dir
+def test_reordered_articles_follow_index(work_dir):
+    #sort memory this small splits sorts of article
+    #pointers into several runs
+    volume = Volume(uuid.uuid4(), 100, 10**7, work_dir, block_size=256,
+                    dedup_entries=10000, reorder_articles=True,
+                    sort_memory=1)
+    titles = ['title %04d' % i for i in range(3000)]
+    random.Random(0).shuffle(titles)
+    articles = {}
+    for i, title in enumerate(titles):
+        small = i % 3
+        articles[title] = 'article %d ' % (i % 700) * (1 if small else 20)
+        digest = payload_digest(articles[title])
+        location = volume.payload_location(digest)
+        if location:
+            volume.add_ref(title, location)
+        elif small:
+            volume.add_to_block(title, articles[title], digest=digest)
+        else:
+            volume.add(title, articles[title], digest=digest)
+    reader = read_volume(volume, work_dir)
+    assert list(reader.titles()) == sorted(titles)
+    for i, title in enumerate(reader.titles()):
+        assert reader.article(i) == articles[title]
+    items = [reader.item(i) for i in range(len(reader))]
+    units = [pos - reader.article_offset for pos, _length in reader.units()]
+    reader.close()
+    #titles with identical payloads share it
+    locations = set((ptr, offset) for _index2_ptr, ptr, offset in items)
+    assert len(locations) == len(set(articles.itervalues()))
+    assert NO_BLOCK in [offset for _ptr, _ptr, offset in items]
+    assert len(set(offset for _ptr, _ptr, offset in items)) > 1
+    first_references = []
+    for _index2_ptr, article_ptr, _offset in items:
+        if article_ptr not in first_references:
+            first_references.append(article_ptr)
+    assert first_references == units
+
+
+def read_section(reader, name):
+    offset, length = reader.metadata['sections'][name]
+    start = reader.article_offset + offset
+    return reader.data[start:start+length]
+
+
+@with_work_dir
+def test_extent_checksums_cover_volume(work_dir):
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir, extent_size=64,
+                    sections=[BloomFilter(0.01)])
+    for i in range(20):
+        volume.add('t%02d' % i, 'article %d' % i)
+    reader = read_volume(volume, work_dir)
+    sections = reader.metadata['sections']
+    #extent checksums are always the last section
+    offset, _length = sections[EXTENT_CHECKSUMS]
+    assert offset == max(o for o, _l in sections.itervalues())
+    table = read_section(reader, EXTENT_CHECKSUMS)
+    covered = reader.data[spec_len(HEADER_SPEC):
+                          reader.article_offset + offset]
+    reader.close()
+    extent_size, count = struct.unpack('>LL', table[:8])
+    assert extent_size == 64
+    assert count == (len(covered) + 63)/64
+    crcs = struct.unpack('>%dL' % count, table[8:8+4*count])
+    for i, crc in enumerate(crcs):
+        extent = covered[i*extent_size:(i+1)*extent_size]
+        assert zlib.crc32(extent) & 0xffffffff == crc
+    assert table[8+4*count:].strip('\0') == ''
+
+
+def file_sha1(file_name):
+    for _pos, sha1 in calcsha1(file_name, spec_len(HEADER_SPEC[:2])):
+        pass
+    return sha1.hexdigest()
+
+
+@with_work_dir
+def test_streamed_sha1_matches_file(work_dir):
+    for kwargs in (dict(),
+                   dict(block_size=64),
+                   dict(output_file_name=os.path.join(work_dir, 'test.aar'),
+                        index_reserve=1000),
+                   dict(extent_size=64, sections=[JumpTable()]),
+                   dict(reorder_articles=True, front_coded_index=True)):
+        volume = Volume(uuid.uuid4(), 100, 10**6, work_dir, **kwargs)
+        for i in range(50):
+            volume.add('t%02d' % (50 - i), 'article %d' % i)
+        file_name = volume.finalize(os.path.join(work_dir, 'test.aar'), {},
+                                    volume_count=1)
+        reader = VolumeReader(file_name)
+        assert reader.header['sha1sum'] == volume.sha1sum
+        reader.close()
+        assert volume.sha1sum == file_sha1(file_name), kwargs
+        os.remove(file_name)
+
+
+@with_work_dir
+def test_compiled_volumes_have_file_sha1(work_dir):
+    count = len(compile_dummy(work_dir))
+    for file_name in glob.glob(os.path.join(work_dir, '*')):
+        os.remove(file_name)
+    #checksums are calculated while volumes are written
+    #when number of volumes is known in advance
+    for file_name, _articles in compile_dummy(work_dir, volume_count=count):
+        file_name = os.path.join(work_dir, file_name)
+        reader = VolumeReader(file_name)
+        assert reader.header['sha1sum'] == file_sha1(file_name)
+        reader.close()
+
+
+def read_jump_table(reader):
+    data = read_section(reader, JumpTable.name)
+    pos = 0
+    levels = ord(data[pos])
+    pos += 1
+    counts = struct.unpack('>%dL' % levels, data[pos:pos+4*levels])
+    pos += 4*levels
+    table = []
+    for count in counts:
+        entries = {}
+        for i in range(count):
+            key_len = ord(data[pos])
+            key = data[pos+1:pos+1+key_len]
+            pos += 1 + key_len
+            entries[key] = struct.unpack('>LL', data[pos:pos+8])
+            pos += 8
+        table.append(entries)
+    return table
+
+
+@with_work_dir
+def test_jump_table_ranges(work_dir):
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir,
+                    sections=[JumpTable()])
+    for title in (u'ex', u'b', u'abc', u'e\u0301x', u'ab'):
+        volume.add(title.encode('utf8'), 'text')
+    reader = read_volume(volume, work_dir)
+    titles = list(reader.titles())
+    table = read_jump_table(reader)
+    reader.close()
+    assert len(table) == 3
+    for level, entries in enumerate(table, 1):
+        for key, (start, end) in entries.items():
+            matching = [i for i, title in enumerate(titles)
+                        if (level, key) in JumpTable().prefix_keys(title)]
+            assert matching == range(start, end)
+    #combining mark stays with its base letter
+    assert table[1][primary_collation_key(u'ex').getByteArray()] == (3, 5)
+
+
+def read_collation_keys(reader):
+    data = read_section(reader, CollationKeys.name)
+    count = len(reader)
+    keys = {}
+    for i in range(ord(data[0])):
+        strength, offset = struct.unpack('>BL', data[1+5*i:6+5*i])
+        key_offsets = struct.unpack('>%dL' % (count + 1),
+                                    data[offset:offset+4*(count + 1)])
+        start = offset + 4*(count + 1)
+        keys[strength] = [data[start+key_offsets[j]:start+key_offsets[j+1]]
+                          for j in range(count)]
+    return keys
+
+
+@with_work_dir
+def test_collation_keys_match_icu(work_dir):
+    titles = [u'ex', u'Ex', u'e\u0301x', u'\xe9x', u'b', u'abc', u'ab',
+              u'\u0430\u0431\u0432', u'a-b', u'ab']
+    strengths = ['quaternary', 'primary', 'secondary']
+    #keys come from index sort or, for presorted
+    #volume, from checking that it is in order
+    for presorted in (False, True):
+        volume = Volume(uuid.uuid4(), 100, 10**6, work_dir,
+                        presorted=presorted,
+                        sections=[CollationKeys(strengths)])
+        if presorted:
+            titles.sort(key=lambda title: collation_key(title).getByteArray())
+        for title in titles:
+            volume.add(title.encode('utf8'), 'text')
+        reader = read_volume(volume, work_dir)
+        sorted_titles = [title.decode('utf8') for title in reader.titles()]
+        keys = read_collation_keys(reader)
+        reader.close()
+        os.remove(reader.file_name)
+        assert sorted(keys) == sorted(COLLATION_STRENGTHS[strength]
+                                      for strength in strengths)
+        for strength, strength_keys in keys.iteritems():
+            collator = Collator.createInstance(Locale(''))
+            collator.setStrength(strength)
+            assert strength_keys == [
+                collator.getCollationKey(title).getByteArray()
+                for title in sorted_titles]
+
+
+class InterruptedArticleSource(DummyArticleSource):
+
+    def __init__(self, length, interrupt_at=None):
+        DummyArticleSource.__init__(self, argparse.Namespace(len=length))
+        self.interrupt_at = interrupt_at
+
+    def __iter__(self):
+        for article in DummyArticleSource.__iter__(self):
+            if self.position['items'] == self.interrupt_at:
+                raise KeyboardInterrupt
+            yield article
+
+
+def compile_volumes(work_dir, article_source, max_file_size=4000, **kwargs):
+    """
+    Compile articles into volumes in `work_dir`, return volume
+    file names with lists of titles and articles in index order
+    """
+    output_file_name = os.path.join(work_dir, 'dummy.aar')
+    Volume.number = 0
+    c = compiler.Compiler(article_source, output_file_name, max_file_size,
+                          work_dir, {}, **kwargs)
+    c.run()
+    volumes = []
+    for file_name in sorted(glob.glob(os.path.join(work_dir, '*.aar'))):
+        reader = VolumeReader(file_name)
+        volumes.append((os.path.basename(file_name),
+                        [(title, reader.article(i))
+                         for i, title in enumerate(reader.titles())]))
+        reader.close()
+    return volumes
+
+
+def compile_dummy(work_dir, interrupt_at=None, **kwargs):
+    return compile_volumes(work_dir,
+                           InterruptedArticleSource(2000, interrupt_at),
+                           checkpoint_interval=1e-9, **kwargs)
+
+
+def check_resumed_build(work_dir, **kwargs):
+    full_work_dir = os.path.join(work_dir, 'full')
+    resumed_work_dir = os.path.join(work_dir, 'resumed')
+    os.mkdir(full_work_dir)
+    os.mkdir(resumed_work_dir)
+    expected = compile_dummy(full_work_dir, **kwargs)
+    assert len(expected) > 1
+    try:
+        compile_dummy(resumed_work_dir, interrupt_at=1234, **kwargs)
+    except KeyboardInterrupt:
+        pass
+    else:
+        assert False, 'Compilation was not interrupted'
+    assert os.path.exists(os.path.join(resumed_work_dir, 'checkpoint.json'))
+    assert compile_dummy(resumed_work_dir, resume=True, **kwargs) == expected
+
+
+@with_work_dir
+def test_resumed_build_with_blocks(work_dir):
+    check_resumed_build(work_dir, block_size=512, small_article_size=256)
+
+
+@with_work_dir
+def test_resumed_build_with_index_reserve(work_dir):
+    check_resumed_build(work_dir, index_reserve=2000)
+
+
+class ConvertingArticleSource(compiler.ArticleSource):
+
+    reuses_previous = True
+
+    def __init__(self, inputs):
+        super(ConvertingArticleSource, self).__init__(self)
+        self.inputs = inputs
+        self.converted = []
+
+    @property
+    def metadata(self):
+        return {}
+
+    def __iter__(self):
+        for title, text in sorted(self.inputs.iteritems()):
+            digest = compiler.source_digest(title, text)
+            if self.previous and self.previous.unchanged(title, digest):
+                for article in self.previous.articles(title):
+                    yield article
+                continue
+            self.converted.append(title)
+            yield compiler.Article(title, json.dumps((text.upper(), [])),
+                                   source_digest=digest)
+            #derived entry, reused together with its article
+            yield compiler.Article('see ' + title, json.dumps(('', [])),
+                                   isredirect=True, counted=False,
+                                   source_digest=digest)
+
+
+@with_work_dir
+def test_incremental_build_reuses_unchanged_articles(work_dir):
+    previous_work_dir, next_work_dir, fresh_work_dir = [
+        os.path.join(work_dir, name) for name in ('previous', 'next', 'fresh')]
+    for name in (previous_work_dir, next_work_dir, fresh_work_dir):
+        os.mkdir(name)
+    inputs = dict(('title %03d' % i, 'input %d ' % i * (i % 7 + 1))
+                  for i in range(300))
+    compile_volumes(previous_work_dir, ConvertingArticleSource(inputs))
+    changed = set(title for i, title in enumerate(sorted(inputs))
+                  if i % 10 == 0)
+    for title in changed:
+        inputs[title] += 'changed'
+    file_names = sorted(glob.glob(os.path.join(previous_work_dir, '*.aar')))
+    assert len(file_names) > 1
+    previous = compiler.PreviousBuild(
+        file_names, os.path.join(previous_work_dir, 'dummy.manifest'))
+    source = ConvertingArticleSource(inputs)
+    source.previous = previous
+    try:
+        volumes = compile_volumes(next_work_dir, source)
+    finally:
+        previous.close()
+    assert previous.reused == len(inputs) - len(changed)
+    assert sorted(source.converted) == sorted(changed)
+    assert volumes == compile_volumes(fresh_work_dir,
+                                      ConvertingArticleSource(inputs))
+
+
+def title_key(title):
+    return compiler.collation_key(title.decode('utf8')).getByteArray()
+
+
+def check_sort_in_runs(work_dir, sort_processes):
+    #sort memory this small sorts index in runs of 1000 items
+    volume = Volume(uuid.uuid4(), 100, 10**7, work_dir,
+                    sort_processes=sort_processes, sort_memory=1)
+    titles = ['title %d' % (i % 1500) for i in range(3500)]
+    random.Random(sort_processes).shuffle(titles)
+    expected = {}
+    for i, title in enumerate(titles):
+        article = 'article %d' % i
+        expected.setdefault(title, []).append(article)
+        #keys supplied by article source for some items only
+        sort_key = title_key(title) if i > 1200 else None
+        volume.add(title, article, sort_key=sort_key)
+    reader = read_volume(volume, work_dir)
+    sorted_titles = list(reader.titles())
+    articles = {}
+    for i, title in enumerate(sorted_titles):
+        articles.setdefault(title, []).append(reader.article(i))
+    reader.close()
+    keys = [title_key(title) for title in sorted_titles]
+    assert keys == sorted(keys)
+    #equal titles keep order they were added in
+    assert articles == expected
+
+
+@with_work_dir
+def test_volume_sorts_index_in_runs(work_dir):
+    check_sort_in_runs(work_dir, 1)
+
+
+@with_work_dir
+def test_volume_sorts_index_runs_in_processes(work_dir):
+    check_sort_in_runs(work_dir, 2)
+
+
+@with_work_dir
+def test_sort_records_merges_runs(work_dir):
+    records = [struct.pack('>LL', random.randint(0, 100), i)
+               for i in range(1000)]
+    file_name = os.path.join(work_dir, 'records')
+    with open(file_name, 'wb') as f:
+        f.write(''.join(records))
+    assert list(sort_records(file_name, 8, 64, work_dir)) == sorted(records)
+    assert os.listdir(work_dir) == ['records']
+
+
+@with_work_dir
+def test_range_volumes_partition_sorted_titles(work_dir):
+    range_work_dir = os.path.join(work_dir, 'range')
+    os.mkdir(range_work_dir)
+    #dummy titles are numbered, their collation order is not numeric
+    source = DummyArticleSource(argparse.Namespace(len=2000))
+    expected = compile_volumes(work_dir, source)
+    source = DummyArticleSource(argparse.Namespace(len=2000))
+    volumes = compile_volumes(range_work_dir, source, range_volumes=True)
+    assert len(volumes) > 1
+    all_articles = []
+    previous_last = None
+    for number, (file_name, articles) in enumerate(volumes, 1):
+        reader = VolumeReader(os.path.join(range_work_dir, file_name))
+        header, metadata = reader.header, reader.metadata
+        reader.close()
+        assert header['volume'] == number
+        assert header['of'] == len(volumes)
+        titles = [title for title, _article in articles]
+        assert metadata['first_title'] == titles[0].decode('utf8')
+        assert metadata['last_title'] == titles[-1].decode('utf8')
+        if previous_last is not None:
+            assert title_key(previous_last) < title_key(titles[0])
+        previous_last = titles[-1]
+        all_articles.extend(articles)
+    keys = [title_key(title) for title, _article in all_articles]
+    assert keys == sorted(keys)
+    assert sorted(all_articles) == sorted(article for _file_name, articles
+                                          in expected
+                                          for article in articles)
+
+
+class ListArticleSource(compiler.ArticleSource):
+
+    def __init__(self, articles, redirects=()):
+        super(ListArticleSource, self).__init__(self)
+        self.articles = articles
+        self.redirects = redirects
+
+    @property
+    def metadata(self):
+        return {}
+
+    def __iter__(self):
+        for title, text in self.articles:
+            yield compiler.Article(title, text,
+                                   isredirect=title in self.redirects)
+
+
+@with_work_dir
+def test_duplicates_shared_within_volumes(work_dir):
+    #few distinct payloads, some small enough for blocks
+    articles = [('title %04d' % i,
+                 json.dumps(('payload %d ' % (i % 13) * (i % 13 * 5 + 1),
+                             [])))
+                for i in range(600)]
+    for compress_threads in (0, 4):
+        build_work_dir = os.path.join(work_dir, str(compress_threads))
+        os.mkdir(build_work_dir)
+        volumes = compile_volumes(build_work_dir, ListArticleSource(articles),
+                                  max_file_size=8000, block_size=512,
+                                  small_article_size=64, dedup_entries=100,
+                                  compress_threads=compress_threads)
+        assert len(volumes) > 1
+        compiled = []
+        for file_name, volume_articles in volumes:
+            compiled.extend(volume_articles)
+            reader = VolumeReader(os.path.join(build_work_dir, file_name))
+            locations = set(reader.item(i)[1:] for i in range(len(reader)))
+            reader.close()
+            #payloads repeated across volumes are stored again,
+            #but only once in each volume
+            assert len(locations) == len(set(article for _title, article
+                                             in volume_articles))
+        assert sorted(compiled) == articles
+
+
+@with_work_dir
+def test_hot_articles_go_to_first_volume(work_dir):
+    articles = [('title %03d' % i, json.dumps(('article %d ' % i * 10, [])))
+                for i in range(300)]
+    hot = set(['title %03d' % i for i in (7, 150, 299)])
+    #redirect to a hot article is hot too
+    redirect = json.dumps(('', [], {'r': 'title 150#section'}))
+    articles.append(('alias 150', redirect))
+    lines = ['title 007 30', 'title 150 20', 'title 299 10',
+             'title 001 5', 'title 002 5', 'no such title 5']
+    page_views = compiler.top_page_views(lines, 3)
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        volumes = compile_volumes(work_dir,
+                                  ListArticleSource(articles, ['alias 150']),
+                                  page_views=page_views)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    assert len(volumes) > 2
+    (_file_name, hot_articles), rest = volumes[0], volumes[1:]
+    assert [title for title, _article in hot_articles] == [
+        'alias 150', 'title 007', 'title 150', 'title 299']
+    compiled = list(hot_articles)
+    for _file_name, volume_articles in rest:
+        titles = [title for title, _article in volume_articles]
+        assert not hot.intersection(titles)
+        keys = [title_key(title) for title in titles]
+        assert keys == sorted(keys)
+        compiled.extend(volume_articles)
+    assert sorted(compiled) == sorted(articles)
+    assert 'Hot volume covers 80.0% of 75 page views' in output
+
+
+@with_work_dir
+def test_bloom_filter_contains_titles(work_dir):
+    volume = Volume(uuid.uuid4(), 100, 10**6, work_dir,
+                    sections=[BloomFilter(0.01)])
+    titles = [u'Abc', u'b\xe9', u'\u0430\u0431\u0432']
+    for title in titles:
+        volume.add(title.encode('utf8'), 'text')
+    reader = read_volume(volume, work_dir)
+    data = read_section(reader, BloomFilter.name)
+    reader.close()
+    hash_count, bit_count = struct.unpack('>BL', data[:5])
+    bits = bytearray(data[5:])
+    assert len(bits) == (bit_count + 7)/8
+    def contains(title):
+        key = primary_collation_key(title).getByteArray()
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in positions(bloom_hashes(key), hash_count,
+                                        bit_count))
+    #keys are primary strength, case and accents don't matter
+    for title in titles + [u'abc', u'be']:
+        assert contains(title)
@@ -0,0 +1,54 @@
+import os
+import uuid
+from StringIO import StringIO
+
+from aardtools.compiler import Volume, VolumeReader
+from aardtools.delta import (PatchWriter, PatchReader, OP_COPY, OP_DATA,
+                             OP_END, compare)
+
+from test_compiler import with_work_dir
+
+
+def test_patch_operations_roundtrip():
+    f = StringIO()
+    writer = PatchWriter(f)
+    writer.data('head')
+    writer.copy(0, 10, 5)
+    writer.copy(0, 15, 7)
+    writer.copy(1, 0, 3)
+    writer.data('a')
+    writer.data('b')
+    writer.end()
+    writer.data('tail')
+    writer.end()
+    writer.close()
+    reader = PatchReader(StringIO(f.getvalue()))
+    assert list(reader.operations()) == [(OP_DATA, 'head'),
+                                         (OP_COPY, (0, 10, 12)),
+                                         (OP_COPY, (1, 0, 3)),
+                                         (OP_DATA, 'ab'),
+                                         (OP_END, None)]
+    assert list(reader.operations()) == [(OP_DATA, 'tail'),
+                                         (OP_END, None)]
+
+
+@with_work_dir
+def test_compare_across_volumes(work_dir):
+    readers = []
+    def volume(name, articles):
+        v = Volume(uuid.uuid4(), 100, 10**6, work_dir)
+        for title, text in articles:
+            v.add(title, text)
+        reader = VolumeReader(v.finalize(os.path.join(work_dir, name), {}))
+        readers.append(reader)
+        return reader
+    try:
+        old = [volume('old1', [('a', '1'), ('b', '2'), ('c', '3')]),
+               volume('old2', [('d', '4'), ('A', '5')])]
+        new = [volume('new1', [('a', '1'), ('b', 'x'), ('e', '3')]),
+               volume('new2', [('A', '5'), ('f', '6')])]
+        assert compare(old, new) == dict(added=2, removed=2,
+                                         changed=1, unchanged=2)
+    finally:
+        for reader in readers:
+            reader.close()